@@ -0,0 +1,98 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import fftbackend
+from catalog import sweep_files
+
+
+# Frequency-domain weights turning a displacement spectrum in pm into acceleration in
+# m/s^2: -(2 pi f)^2, multiplied by a band-limiting window with raised-cosine edges
+# (taper is the fraction of each band edge frequency used for the roll-off)
+def acceleration_weights(n_samples, sample_rate, band=(5, 2000), taper=0.2):
+    frequencies = fftbackend.rfftfreq(n_samples, 1 / sample_rate)
+    low, high = band
+    window = ((frequencies >= low) & (frequencies <= high)).astype('double')
+    rise = (frequencies >= low * (1 - taper)) & (frequencies < low)
+    window[rise] = 0.5 - 0.5 * np.cos(np.pi * (frequencies[rise] - low * (1 - taper)) / (low * taper))
+    fall = (frequencies > high) & (frequencies <= high * (1 + taper))
+    window[fall] = 0.5 + 0.5 * np.cos(np.pi * (frequencies[fall] - high) / (high * taper))
+    return -(2 * np.pi * frequencies) ** 2 * window * 1e-12
+
+
+# Convert a stack of equal-length displacement traces (points x samples, pm) to
+# acceleration in one call. Returns the RMS acceleration of every trace (Parseval on the
+# weighted spectrum) and, when drive frequencies are given, the acceleration amplitude
+# of the drive frequency and its harmonics (points x n_harmonics). With
+# return_traces=True the band-limited acceleration traces are returned as well.
+def displacement_to_acceleration(traces, sample_rate, drive_frequencies=None, n_harmonics=5,
+                                 band=(5, 2000), taper=0.2, return_traces=False):
+    traces = np.atleast_2d(traces)
+    n_samples = traces.shape[1]
+    spectrum = fftbackend.rfft(traces, axis=1)
+    spectrum *= acceleration_weights(n_samples, sample_rate, band, taper)
+
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    # Every bin except DC (and Nyquist for even lengths) stands for two in the full spectrum
+    power[:, 1:(n_samples + 1) // 2] *= 2
+    rms = np.sqrt(power.sum(axis=1)) / n_samples
+
+    results = [rms]
+    if drive_frequencies is not None:
+        harmonics = np.outer(drive_frequencies, np.arange(1, n_harmonics + 1))
+        bins = np.rint(harmonics * n_samples / sample_rate).astype(int)
+        bins = np.clip(bins, 0, spectrum.shape[1] - 1)
+        results.append(2 * np.abs(np.take_along_axis(spectrum, bins, axis=1)) / n_samples)
+    if return_traces:
+        results.append(fftbackend.irfft(spectrum, n=n_samples, axis=1))
+    return results[0] if len(results) == 1 else tuple(results)
+
+
+# Read the displacement of several converted .aws files into one stack, cut to the
+# shortest trace so they share one FFT length
+def load_stack(file_paths, column='Pos0'):
+    traces = []
+    sample_rate = None
+    for file_path in file_paths:
+        data = pd.read_csv(file_path, header=None, names=['Time', 'Pos0', 'Pos1', 'Pos2'], usecols=['Time', column])
+        if sample_rate is None:
+            sample_rate = 1 / (data['Time'][1] - data['Time'][0])
+        traces.append(data[column].to_numpy(dtype='double'))
+    n_samples = min(len(trace) for trace in traces)
+    stack = np.empty((len(traces), n_samples))
+    for row, trace in zip(stack, traces):
+        row[:] = trace[:n_samples]
+    stack -= stack.mean(axis=1, keepdims=True)
+    return sample_rate, stack
+
+
+def main(run_id=None):
+    n_harmonics = 5
+    band = (5, 2000)  # Hz
+    batch_size = 32  # traces converted per call
+
+    points = []
+    for rounded_amplitude, rounded_frequency, file_path in sweep_files('csv', run_id):
+        if not os.path.isfile(file_path):
+            print(f"File not found: {file_path}")
+            continue
+        points.append((rounded_amplitude, rounded_frequency, file_path))
+
+    for start in range(0, len(points), batch_size):
+        batch = points[start:start + batch_size]
+        sample_rate, stack = load_stack([file_path for _, _, file_path in batch])
+        rms, amplitudes = displacement_to_acceleration(stack, sample_rate, [f for _, f, _ in batch],
+                                                       n_harmonics=n_harmonics, band=band)
+
+        with open('output_rms_ids.txt', 'a') as file:
+            for (rounded_amplitude, rounded_frequency, _), point_rms, point_amplitudes in zip(batch, rms, amplitudes):
+                print(f"{rounded_amplitude} V, {rounded_frequency} Hz: RMS acceleration {point_rms} m/s^2")
+                harmonics = ', '.join(f'{a}' for a in point_amplitudes)
+                file.write(f'{rounded_amplitude} V, {rounded_frequency} Hz, {point_rms}, {harmonics}\n')
+        print("\nRMS acceleration results saved to output_rms_ids.txt")
+
+    print("\nEnd")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,99 @@
+import time
+import numpy as np
+import h5py
+
+# Waveform preamble values needed to turn the raw codes back into seconds and volts
+scaling_keys = ['xincr', 'xzero', 'ymult', 'yzero', 'yoff']
+
+
+# Query the waveform preamble of the current data source of the oscilloscope
+def query_scaling(scope):
+    return {key: float(scope.query(f'wfmoutpre:{key}?')) for key in scaling_keys}
+
+
+# Convert raw codes to volts with the preamble of the capture, in place on one array of
+# the requested dtype (float32 halves the memory of every later step)
+def scale_codes(codes, scaling, dtype='double'):
+    wave = np.array(codes, dtype=dtype)
+    wave -= scaling['yoff']
+    wave *= scaling['ymult']
+    wave += scaling['yzero']
+    return wave
+
+
+# Time vector of a capture from its preamble
+def time_vector(scaling, start, stop, dtype='double'):
+    times = np.arange(start, stop, dtype=dtype)
+    times *= scaling['xincr']
+    times += scaling['xzero']
+    return times
+
+
+# Raw waveform archive in HDF5: one group per capture, one compressed and chunked
+# dataset of raw int8/int16 codes per channel with its scaling as attributes, and the
+# sweep parameters and instrument IDs as group attributes.
+class WaveformArchive:
+    def __init__(self, path, mode='a', chunk_size=2 ** 16, compression='gzip', compression_level=1):
+        self.file = h5py.File(path, mode)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_level = compression_level
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    # Store one capture. channels maps channel name -> raw codes, scaling maps channel
+    # name -> preamble dict, every other keyword ends up as attribute of the capture.
+    # Writing an existing capture name replaces it
+    def write_capture(self, name, channels, scaling, **attrs):
+        if name in self.file:
+            del self.file[name]
+        group = self.file.create_group(name)
+        group.attrs['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        for key, value in attrs.items():
+            group.attrs[key] = value
+        for channel, codes in channels.items():
+            codes = np.asarray(codes)
+            dataset = group.create_dataset(
+                channel, data=codes, chunks=(min(self.chunk_size, len(codes)),),
+                compression=self.compression,
+                compression_opts=self.compression_level if self.compression == 'gzip' else None,
+                shuffle=codes.dtype.itemsize > 1)
+            for key in scaling_keys:
+                dataset.attrs[key] = scaling[channel][key]
+        self.file.flush()
+        return group
+
+    def captures(self):
+        return list(self.file.keys())
+
+    def channels(self, name):
+        return list(self.file[name].keys())
+
+    def attrs(self, name):
+        return dict(self.file[name].attrs)
+
+    def scaling(self, name, channel):
+        return {key: float(self.file[name][channel].attrs[key]) for key in scaling_keys}
+
+    # Read samples [start, stop) of one channel; only the chunks covering the range are
+    # decompressed. Returns volts, or the raw codes with scaled=False
+    def read(self, name, channel, start=0, stop=None, scaled=True):
+        dataset = self.file[name][channel]
+        if stop is None:
+            stop = dataset.shape[0]
+        codes = dataset[start:stop]
+        if not scaled:
+            return codes
+        return scale_codes(codes, self.scaling(name, channel))
+
+    def read_time(self, name, channel, start=0, stop=None):
+        if stop is None:
+            stop = self.file[name][channel].shape[0]
+        return time_vector(self.scaling(name, channel), start, stop)
@@ -1,8 +1,9 @@
 import os
 import csv
 import IDS
+from catalog import RunCatalog
 
-def process_file(ids, filepath):
+def process_file(ids, filepath, catalog=None):
     # Open the file
     stream = ids.streaming.loadFile(filepath)
     print(f"Processing file: {filepath}")
@@ -26,16 +27,22 @@ def process_file(ids, filepath):
                 csvwriter.writerow(record)
     print(f"Saved to: {output_csv}")
 
+    # Register the .csv with the run and sweep point of its .aws file
+    if catalog is not None:
+        catalog.register_derived(output_csv, filepath, kind='csv')
+
 def main(folder_path):
     # Initialize the IDS device
     ids = IDS.Device("192.168.1.1")
     ids.connect()
 
-    # Loop through all files in the folder
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.aws'):
-            filepath = os.path.join(folder_path, filename)
-            process_file(ids, filepath)
+    # Loop through all files in the folder and its run directories
+    with RunCatalog() as catalog:
+        for directory, _, filenames in os.walk(folder_path):
+            for filename in filenames:
+                if filename.endswith('.aws'):
+                    filepath = os.path.join(directory, filename)
+                    process_file(ids, filepath, catalog)
 
 if __name__ == '__main__':
     # Specify the folder path containing .aws files
@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import sys
+import numpy as np
+
+
+# Read 'amplitude V, frequency Hz, value[, ...]' lines as written by the analysis scripts.
+# Returns amplitude, frequency and complex response arrays (phase in radians if given)
+def load_text(file_path, magnitude_column=2, phase_column=None):
+    amplitudes, frequencies, responses = [], [], []
+    with open(file_path, 'r') as file:
+        for line in file:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = [field.split()[0] for field in line.strip().split(', ')]
+            if fields[magnitude_column] == 'None':
+                continue
+            magnitude = float(fields[magnitude_column])
+            phase = float(fields[phase_column]) if phase_column is not None else 0.0
+            amplitudes.append(float(fields[0]))
+            frequencies.append(float(fields[1]))
+            responses.append(magnitude * np.exp(1j * phase))
+    return np.array(amplitudes), np.array(frequencies), np.array(responses)
+
+
+# Read the fundamental H1 and its phase from a table of harmonics.write_table, e.g.
+# output_ids_harmonics.txt. The columns are looked up in its '# ' header line
+def load_harmonic_table(file_path):
+    with open(file_path, 'r') as file:
+        header = file.readline()
+    if not header.startswith('#'):
+        raise ValueError(f'{file_path} has no harmonic table header')
+    columns = [name.strip() for name in header[1:].split(',')]
+    return load_text(file_path, columns.index('H1'), columns.index('phase'))
+
+
+# Read the fundamental from the results store of workers.py
+def load_results(store_path='results.db', harmonic=0):
+    db = sqlite3.connect(store_path)
+    rows = db.execute('SELECT amplitude, frequency, result FROM results').fetchall()
+    db.close()
+    amplitudes = np.array([row[0] for row in rows])
+    frequencies = np.array([row[1] for row in rows])
+    responses = np.array([json.loads(row[2])['harmonics'][harmonic] for row in rows], dtype=complex)
+    return amplitudes, frequencies, responses
+
+
+# Arrange the measurements on the amplitude x frequency grid. Repeats of a point go along
+# the first axis; returns the grid axes, the values (repeats x amplitudes x frequencies,
+# NaN where a repeat is missing) and the number of repeats of every cell
+def to_grid(amplitudes, frequencies, responses):
+    amplitude_axis, amplitude_index = np.unique(np.round(amplitudes, 6), return_inverse=True)
+    frequency_axis, frequency_index = np.unique(np.round(frequencies, 6), return_inverse=True)
+    counts = np.zeros((len(amplitude_axis), len(frequency_axis)), dtype=int)
+    np.add.at(counts, (amplitude_index, frequency_index), 1)
+    values = np.full((counts.max(), len(amplitude_axis), len(frequency_axis)), np.nan, dtype=complex)
+    # Running repeat number of every measurement within its cell
+    order = np.lexsort((np.arange(len(responses)), frequency_index, amplitude_index))
+    cell = amplitude_index[order] * len(frequency_axis) + frequency_index[order]
+    first = np.r_[0, np.flatnonzero(np.diff(cell)) + 1]
+    repeat = np.arange(len(order)) - np.repeat(first, np.diff(np.r_[first, len(order)]))
+    values[repeat, amplitude_index[order], frequency_index[order]] = responses[order]
+    return amplitude_axis, frequency_axis, values, counts
+
+
+# Cell means of n_bootstrap resamplings of the repeats, drawn chunk_size replicates at a
+# time. Every cell is resampled with its own number of repeats. Returns (n_bootstrap + 1)
+# x amplitudes x frequencies, the first entry is the plain mean; the replicates of cells
+# with fewer than 2 repeats are NaN (no spread can be estimated), empty cells are NaN
+def bootstrap_means(values, counts, n_bootstrap=1000, seed=0, chunk_size=100):
+    rng = np.random.default_rng(seed)
+    n_repeats = values.shape[0]
+    filled = np.where(np.isnan(values), 0, values)
+    # Draws beyond the number of repeats of a cell are masked out
+    used = np.arange(n_repeats)[:, np.newaxis, np.newaxis] < counts
+    means = np.empty((n_bootstrap + 1,) + counts.shape, dtype=values.dtype)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means[0] = filled.sum(axis=0) / counts
+        for start in range(0, n_bootstrap, chunk_size):
+            n = min(chunk_size, n_bootstrap - start)
+            draws = rng.random((n, n_repeats) + counts.shape)
+            # Only draw from the repeats that exist in a cell
+            index = np.minimum((draws * counts).astype(int), np.maximum(counts - 1, 0))
+            resampled = np.take_along_axis(filled[np.newaxis], index, axis=1)
+            means[1 + start:1 + start + n] = (resampled * used).sum(axis=1) / counts
+    means[1:, counts < 2] = np.nan
+    return means
+
+
+# Amplitude linearity: response = s1 * A + s2 * A^2 (+ offset) at every frequency.
+# The design matrix is shared, so all frequencies and bootstrap replicates are solved
+# with one pseudo-inverse. Returns coefficients (replicates x n_terms x frequencies)
+def fit_linearity(amplitude_axis, means, degree=2, offset=False):
+    powers = np.arange(0 if offset else 1, degree + 1)
+    design = amplitude_axis[:, np.newaxis] ** powers
+    return np.einsum('pa,baf->bpf', np.linalg.pinv(design), means), powers
+
+
+# Frequency response of the sensitivity: log|S| and the unwrapped phase of S as
+# polynomials in log f, solved for all bootstrap replicates with one pseudo-inverse
+def fit_frequency_response(frequency_axis, sensitivity, degree=3):
+    x = np.log(frequency_axis)
+    design = x[:, np.newaxis] ** np.arange(degree + 1)
+    inverse = np.linalg.pinv(design)
+    log_magnitude = np.log(np.abs(sensitivity))
+    phase = np.unwrap(np.angle(sensitivity), axis=-1)
+    return log_magnitude @ inverse.T, phase @ inverse.T
+
+
+def evaluate_frequency_response(frequencies, magnitude_coefficients, phase_coefficients):
+    x = np.log(np.asarray(frequencies))[..., np.newaxis] ** np.arange(magnitude_coefficients.shape[-1])
+    return np.exp(x @ magnitude_coefficients) * np.exp(1j * (x @ phase_coefficients))
+
+
+def uncertainty(spread):
+    return 'undetermined' if np.isnan(spread) else spread
+
+
+def main(file_path='output_ids_firstpeak_1.txt'):
+    n_bootstrap = 1000
+    linearity_degree = 2
+    response_degree = 3
+
+    # Only the harmonic tables carry the phase of the fundamental
+    with_phase = 'harmonics' in os.path.basename(file_path)
+    if file_path.endswith('.db'):
+        amplitudes, frequencies, responses = load_results(file_path)
+    elif with_phase:
+        amplitudes, frequencies, responses = load_harmonic_table(file_path)
+    else:
+        amplitudes, frequencies, responses = load_text(file_path)
+    amplitude_axis, frequency_axis, values, counts = to_grid(amplitudes, frequencies, responses)
+    print(f"{len(responses)} measurements on a {len(amplitude_axis)} x {len(frequency_axis)} grid, "
+          f"up to {values.shape[0]} repeats")
+
+    # Frequencies with an unmeasured amplitude cannot be fitted on the common design
+    complete = (counts > 0).all(axis=0)
+    if not complete.all():
+        print(f"Skipping incomplete frequencies: {frequency_axis[~complete]}")
+    frequency_axis = frequency_axis[complete]
+    values = values[:, :, complete]
+    counts = counts[:, complete]
+    single = np.argwhere(counts < 2)
+    if len(single):
+        print("Single measurements, their uncertainty is undetermined: " + ', '.join(
+            f'{amplitude_axis[a]} V {frequency_axis[f]} Hz' for a, f in single))
+
+    means = bootstrap_means(values, counts, n_bootstrap)
+    coefficients, powers = fit_linearity(amplitude_axis, means, linearity_degree)
+    sensitivity = coefficients[:, list(powers).index(1)]
+    magnitude_coefficients, phase_coefficients = fit_frequency_response(frequency_axis, sensitivity, response_degree)
+
+    # NaN spreads (from cells with a single measurement) are reported as undetermined
+    estimate, spread = coefficients[0], coefficients[1:].std(axis=0)
+    with open('calibration_fit.txt', 'w') as file:
+        for j, frequency in enumerate(frequency_axis):
+            terms = ', '.join(f'{np.abs(estimate[k, j])} +- {uncertainty(spread[k, j])}' for k in range(len(powers)))
+            print(f"{frequency} Hz: " + terms)
+            file.write(f'{frequency} Hz, {terms}\n')
+        magnitude_spread = magnitude_coefficients[1:].std(axis=0)
+        file.write('log|S| coefficients: ' + ', '.join(
+            f'{c} +- {uncertainty(s)}' for c, s in zip(magnitude_coefficients[0], magnitude_spread)) + '\n')
+        if with_phase:
+            phase_spread = phase_coefficients[1:].std(axis=0)
+            file.write('phase coefficients: ' + ', '.join(
+                f'{c} +- {uncertainty(s)}' for c, s in zip(phase_coefficients[0], phase_spread)) + '\n')
+    print("\nCalibration coefficients saved to calibration_fit.txt")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,219 @@
+import argparse
+import glob
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import uuid
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PATH = os.path.join(script_dir, 'catalog.db')
+
+
+# SHA-256 of a file, read in blocks
+def file_checksum(file_path, block_size=2 ** 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# SHA-256 over the raw bytes of arrays, for captures stored inside a container file
+def array_checksum(*arrays):
+    digest = hashlib.sha256()
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+# Sweep parameters from the data_<amplitude>_<frequency> file naming convention
+def parse_point(file_path):
+    match = re.match(r'data_([-\d.]+)_([-\d.]+)(?:_retry\d+)?$', os.path.splitext(os.path.basename(file_path))[0])
+    if match is None:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+# Index of every capture written by the acquisition scripts. A run is one execution of a
+# sweep; its files go to runs/<run_id>/ so repeated sweeps never overwrite each other, and
+# every file is registered with its sweep point, device and checksum when it is written.
+# Analysis selects files with indexed queries instead of rebuilding file names.
+class RunCatalog:
+    def __init__(self, path=DEFAULT_PATH):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                        'run_id TEXT PRIMARY KEY, started REAL, script TEXT, directory TEXT, note TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS captures ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT, timestamp REAL, device TEXT, '
+                        'axis TEXT, amplitude REAL, frequency REAL, sample_rate REAL, kind TEXT, '
+                        'path TEXT UNIQUE, capture TEXT, checksum TEXT, source INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS captures_point ON captures (amplitude, frequency)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS captures_run ON captures (run_id, kind)')
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    # Start a run, returns its ID. Its data directory is created below `directory`
+    def new_run(self, script, directory=script_dir, note=''):
+        run_id = f'{time.strftime("%Y%m%d_%H%M%S")}_{uuid.uuid4().hex[:6]}'
+        run_directory = os.path.join(directory, 'runs', run_id)
+        os.makedirs(run_directory, exist_ok=True)
+        self.db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?)', (run_id, time.time(), script, run_directory, note))
+        self.db.commit()
+        return run_id
+
+    def run_directory(self, run_id):
+        return self.db.execute('SELECT directory FROM runs WHERE run_id = ?', (run_id,)).fetchone()[0]
+
+    # Data file of a sweep point within a run
+    def data_file(self, run_id, amplitude, frequency, extension):
+        return os.path.join(self.run_directory(run_id), f'data_{amplitude}_{frequency}.{extension}')
+
+    # Register a written file. Writing the same path again (e.g. a re-measured point)
+    # updates its entry in place, so it keeps its ID and the files derived from it stay
+    # linked. capture names a capture inside a container file such as the HDF5 archive;
+    # checksum=None hashes the file. Returns the capture ID
+    def register(self, file_path, run_id, device, amplitude, frequency, sample_rate=None, axis=None,
+                 kind=None, capture=None, checksum=None, source=None):
+        file_path = os.path.abspath(file_path)
+        key = file_path if capture is None else f'{file_path}#{capture}'
+        if kind is None:
+            kind = os.path.splitext(file_path)[1].lstrip('.')
+        if checksum is None:
+            checksum = file_checksum(file_path)
+        self.db.execute(
+            'INSERT INTO captures (run_id, timestamp, device, axis, amplitude, frequency, sample_rate, '
+            'kind, path, capture, checksum, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(path) DO UPDATE SET run_id = excluded.run_id, timestamp = excluded.timestamp, '
+            'device = excluded.device, axis = excluded.axis, amplitude = excluded.amplitude, '
+            'frequency = excluded.frequency, sample_rate = excluded.sample_rate, kind = excluded.kind, '
+            'capture = excluded.capture, checksum = excluded.checksum, source = excluded.source',
+            (run_id, time.time(), device, axis, amplitude, frequency, sample_rate, kind, key, capture, checksum, source))
+        self.db.commit()
+        return self.db.execute('SELECT id FROM captures WHERE path = ?', (key,)).fetchone()[0]
+
+    # Register a file converted from a registered one (e.g. .csv from .aws) with the
+    # sweep point and run of its source; files derived from a rejected capture stay rejected
+    def register_derived(self, file_path, source_path, kind=None, sample_rate=None):
+        row = self.find(source_path)
+        if row is None:
+            return None
+        if row['kind'] == 'rejected':
+            kind = 'rejected'
+        return self.register(file_path, row['run_id'], row['device'], row['amplitude'], row['frequency'],
+                             sample_rate if sample_rate is not None else row['sample_rate'], row['axis'],
+                             kind, source=row['id'])
+
+    def find(self, file_path):
+        return self.db.execute('SELECT * FROM captures WHERE path = ?', (os.path.abspath(file_path),)).fetchone()
+
+    def runs(self):
+        return self.db.execute('SELECT * FROM runs ORDER BY started').fetchall()
+
+    # Captures matching all given fields, ordered by sweep point and time
+    def captures(self, kind=None, run_id=None, device=None, amplitude=None, frequency=None):
+        conditions, values = [], []
+        for column, value in (('kind', kind), ('run_id', run_id), ('device', device)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                values.append(value)
+        # Sweep values are rounded to 2 decimals in the file names, compare with a tolerance
+        for column, value in (('amplitude', amplitude), ('frequency', frequency)):
+            if value is not None:
+                conditions.append(f'{column} BETWEEN ? AND ?')
+                values.extend((value - 1e-6, value + 1e-6))
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        return self.db.execute(f'SELECT * FROM captures{where} ORDER BY amplitude, frequency, timestamp',
+                               values).fetchall()
+
+    def latest_run(self, kind=None):
+        row = self.db.execute('SELECT run_id FROM captures' + (' WHERE kind = ?' if kind else '')
+                              + ' ORDER BY timestamp DESC LIMIT 1', (kind,) if kind else ()).fetchone()
+        return None if row is None else row[0]
+
+    # Register existing data_<amplitude>_<frequency> files of a directory as one run
+    def import_directory(self, directory, device=None):
+        file_paths = [path for path in sorted(glob.glob(os.path.join(directory, 'data_*.*')))
+                      if parse_point(path) is not None and self.find(path) is None]
+        if not file_paths:
+            return None
+        run_id = f'import_{time.strftime("%Y%m%d_%H%M%S")}_{uuid.uuid4().hex[:6]}'
+        self.db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?)',
+                        (run_id, time.time(), 'import', os.path.abspath(directory), 'imported'))
+        for file_path in file_paths:
+            amplitude, frequency = parse_point(file_path)
+            kind = os.path.splitext(file_path)[1].lstrip('.')
+            self.register(file_path, run_id, device or ('audio' if kind == 'flac' else 'ids'), amplitude, frequency,
+                          kind=kind)
+        return run_id
+
+
+# (amplitude, frequency, path) of the files of one kind from a run (default: the latest
+# run with such files). Without catalog entries the data_<amplitude>_<frequency> files
+# in `directory` are used, as written by the scripts before the catalog existed
+def sweep_files(kind, run_id=None, directory=script_dir, catalog_path=DEFAULT_PATH):
+    if os.path.isfile(catalog_path):
+        with RunCatalog(catalog_path) as catalog:
+            if run_id is None:
+                run_id = catalog.latest_run(kind)
+            if run_id is not None:
+                return [(row['amplitude'], row['frequency'], row['path']) for row in catalog.captures(kind, run_id)]
+    points = []
+    for file_path in glob.glob(os.path.join(directory, f'data_*.{kind}')):
+        point = parse_point(file_path)
+        if point is not None:
+            points.append(point + (file_path,))
+    return sorted(points)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run catalog of the sweep data files')
+    parser.add_argument('--catalog', default=DEFAULT_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('runs', help='list the runs')
+    listing = subparsers.add_parser('list', help='list captures')
+    listing.add_argument('--run', default=None)
+    listing.add_argument('--kind', default=None)
+    importing = subparsers.add_parser('import', help='register existing data_* files of a directory')
+    importing.add_argument('directory')
+    verify = subparsers.add_parser('verify', help='check the checksums of the registered files')
+    verify.add_argument('--run', default=None)
+    args = parser.parse_args()
+
+    with RunCatalog(args.catalog) as catalog:
+        if args.command == 'runs':
+            for row in catalog.runs():
+                count = len(catalog.captures(run_id=row['run_id']))
+                print(f"{row['run_id']}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['started']))}  "
+                      f"{row['script']}  {count} files  {row['directory']}")
+        elif args.command == 'list':
+            for row in catalog.captures(args.kind, args.run):
+                print(f"{row['run_id']}  {row['device']}  {row['amplitude']} V  {row['frequency']} Hz  "
+                      f"{row['sample_rate']}  {row['path']}")
+        elif args.command == 'import':
+            run_id = catalog.import_directory(args.directory)
+            print(f"Imported as run {run_id}" if run_id else "Nothing to import")
+        elif args.command == 'verify':
+            for row in catalog.captures(run_id=args.run):
+                if row['capture'] is not None:
+                    continue
+                file_path = row['path']
+                if not os.path.isfile(file_path):
+                    print(f"Missing: {file_path}")
+                elif file_checksum(file_path) != row['checksum']:
+                    print(f"Checksum mismatch: {file_path}")
+
+
+if __name__ == '__main__':
+    main()
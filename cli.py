@@ -0,0 +1,106 @@
+import argparse
+import importlib
+import os
+import runpy
+import sys
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommand targets: (module, function) pairs are imported when the command runs,
+# plain file names are scripts without main() that are executed as a whole
+ACQUIRE = {
+    'calibration': 'maincalibration_funcgen_scope.py',
+    'scope': 'scope.py',
+    'ids-trace': 'idstrace_simul.py',
+    'aws': ('mainaws', 'main'),
+    'aws-flac': ('mainaws_flac', 'main'),
+    'async': ('orchestrate', 'main'),
+    'server': ('instrument_server', 'main'),
+}
+ANALYSE = {
+    'ids': ('process_csv', 'main'),
+    'multiaxis': ('multiaxis', 'main'),
+    'lockin': ('lockin', 'main'),
+    'accel': ('accel', 'main'),
+    'flac': ('process_flac', 'main'),
+}
+PLOT = {
+    'colorplot': 'colorplot.py',
+    'rms': 'plot_rms_ids_acc.py',
+}
+
+
+def run(target, *args):
+    if isinstance(target, tuple):
+        module, function = target
+        return getattr(importlib.import_module(module), function)(*args)
+    return runpy.run_path(os.path.join(script_dir, target), run_name='__main__')
+
+
+# Save every open figure, used when plotting without a display
+def save_figures(prefix, directory):
+    import matplotlib.pyplot as plt
+    for number in plt.get_fignums():
+        file_path = os.path.join(directory, f'{prefix}_{number}.png')
+        plt.figure(number).savefig(file_path)
+        print(f"Saved {file_path}")
+    plt.close('all')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cli.py', description='Accelerometer calibration workflow')
+    parser.add_argument('--show', action='store_true',
+                        help='open plot windows (default: non-interactive backend, figures saved as png)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    acquire = subparsers.add_parser('acquire', help='run a measurement')
+    acquire.add_argument('target', choices=ACQUIRE)
+
+    convert = subparsers.add_parser('convert', help='convert .aws files to .csv')
+    convert.add_argument('folder', nargs='?', default=script_dir)
+
+    analyse = subparsers.add_parser('analyse', help='analyse sweep data')
+    analyse_targets = analyse.add_subparsers(dest='target', required=True)
+    for name in ANALYSE:
+        target = analyse_targets.add_parser(name)
+        target.add_argument('--run', default=None, help='catalog run to analyse (default: the latest)')
+    psd = analyse_targets.add_parser('psd', help='averaged power spectral density')
+    psd.add_argument('files', nargs='+')
+    fit = analyse_targets.add_parser('fit', help='calibration model fit')
+    fit.add_argument('file', nargs='?', default='output_ids_firstpeak_1.txt')
+    workers = analyse_targets.add_parser('workers', help='distributed analysis (arguments of workers.py)')
+    workers.add_argument('args', nargs=argparse.REMAINDER)
+
+    plot = subparsers.add_parser('plot', help='plot analysis results')
+    plot.add_argument('target', choices=PLOT)
+    plot.add_argument('--output', default='.', help='directory for the saved figures')
+
+    args = parser.parse_args(argv)
+
+    # Headless by default: no GUI backend is loaded unless plots are requested on screen
+    if not args.show:
+        os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    if args.command == 'acquire':
+        run(ACQUIRE[args.target])
+    elif args.command == 'convert':
+        run(('aws2csv', 'main'), args.folder)
+    elif args.command == 'analyse':
+        if args.target == 'psd':
+            run(('psd', 'main'), args.files)
+        elif args.target == 'fit':
+            run(('calibration_fit', 'main'), args.file)
+        elif args.target == 'workers':
+            sys.argv = ['workers.py'] + args.args
+            run(('workers', 'main'))
+        else:
+            run(ANALYSE[args.target], args.run)
+    elif args.command == 'plot':
+        run(PLOT[args.target])
+
+    if args.command == 'plot' and not args.show:
+        save_figures(f'plot_{args.target}', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import math
+from fractions import Fraction
+
+# Coherent (triggered) acquisition: the scope is triggered on the sync output of the
+# AFG31000 and records an exact integer number of drive cycles, so the drive and its
+# harmonics fall on exact FFT bins and the phase is referenced to the drive.
+# Residual leakage comes only from the mismatch of the two instrument clocks (share
+# the 10 MHz reference to remove it).
+
+
+# Number of drive cycles and record length of the shortest coherent record of at least
+# min_duration seconds. Returns (n_cycles, record_length) with
+# record_length / sample_rate == n_cycles / drive_frequency exactly. A drive frequency
+# with a large denominator against the sample rate needs a very long record; raises
+# ValueError if it would exceed max_duration seconds
+def coherent_record(sample_rate, drive_frequency, min_duration, max_duration=None):
+    samples_per_cycle = Fraction(sample_rate).limit_denominator(10 ** 6) / Fraction(drive_frequency).limit_denominator(10 ** 6)
+    cycle_step = samples_per_cycle.denominator  # fewest cycles spanning an integer number of samples
+    n_cycles = max(1, math.ceil(min_duration * drive_frequency / cycle_step)) * cycle_step
+    record_length = int(n_cycles * samples_per_cycle)
+    if max_duration is not None and record_length > max_duration * sample_rate:
+        raise ValueError(f'a coherent record of {drive_frequency} Hz at {sample_rate} Sa/s needs {n_cycles} cycles '
+                         f'({record_length / sample_rate:g} s), more than {max_duration} s')
+    return n_cycles, record_length
+
+
+# Route the sync pulse of the function generator (one rising edge per cycle, at phase 0
+# of the sine) to its trigger output
+def configure_sync_output(funcgen):
+    funcgen.write('OUTPUT:TRIGGER:MODE SYNC')
+
+
+# Trigger the scope on the AUX input once per acquisition and place the trigger at the
+# start of the record, so the first sample is phase 0 of the drive
+def configure_external_trigger(scope, level=1.0, source='AUXILIARY'):
+    scope.write('TRIGGER:A:TYPE EDGE')
+    scope.write(f'TRIGGER:A:EDGE:SOURCE {source}')
+    scope.write('TRIGGER:A:EDGE:SLOPE RISE')
+    scope.write('TRIGGER:A:EDGE:COUPLING DC')
+    scope.write(f'TRIGGER:A:LEVEL:{"AUXIN" if source.upper().startswith("AUX") else source} {level}')
+    scope.write('TRIGGER:A:MODE NORMAL')
+    scope.write('HORIZONTAL:DELAY:MODE OFF')
+    scope.write('HORIZONTAL:POSITION 0')
+
+
+# Set the record length of a coherent capture, returns (n_cycles, record_length).
+# The scope only supports certain record lengths and may change the sample rate with the
+# record length, so both are read back after writing; if the sample rate changed the
+# record is computed again for it. Raises ValueError if the record would be longer than
+# max_duration seconds or the record the scope actually uses does not hold an integer
+# number of cycles (within `tolerance` cycles)
+def configure_coherent_record(scope, drive_frequency, min_duration, max_duration=None, tolerance=1e-6, attempts=2):
+    for _ in range(attempts):
+        sample_rate = float(scope.query('HORIZONTAL:MODE:SAMPLERATE?'))
+        n_cycles, record_length = coherent_record(sample_rate, drive_frequency, min_duration, max_duration)
+        scope.write(f'HORIZONTAL:RECORDLENGTH {record_length}')
+        scope.query('*opc?')
+        actual_length = int(float(scope.query('HORIZONTAL:RECORDLENGTH?')))
+        actual_rate = float(scope.query('HORIZONTAL:MODE:SAMPLERATE?'))
+        if actual_rate == sample_rate:
+            break
+    actual_cycles = actual_length * drive_frequency / actual_rate
+    scope.write(f'data:stop {actual_length}')
+    if abs(actual_cycles - round(actual_cycles)) > tolerance:
+        raise ValueError(f'scope uses {actual_length} samples at {actual_rate} Sa/s instead of {record_length} '
+                         f'samples at {sample_rate} Sa/s: {actual_cycles} cycles of {drive_frequency} Hz '
+                         f'is not coherent')
+    return round(actual_cycles), actual_length
@@ -0,0 +1,126 @@
+import numpy as np
+from scipy.signal import firwin, kaiserord, upfirdn
+
+# Multi-stage anti-alias decimation in front of the analysis. The scope (1e5 Sa/s) and
+# the audio (44.1 kHz) sample far above the drive band (harmonics of <= 300 Hz), so the
+# signal is low-pass filtered and decimated in a few stages of factor <= 10 before the
+# FFT, RMS and peak detection. Every stage is a Kaiser-window FIR evaluated only at the
+# kept samples (polyphase, scipy.signal.upfirdn); the stage state is carried between
+# chunks, so long records are decimated chunk by chunk with the same result as in one go.
+
+
+# Bandwidth that keeps the drive frequency and its first n_harmonics harmonics
+def drive_bandwidth(drive_frequency, n_harmonics=5):
+    return (n_harmonics + 0.5) * drive_frequency
+
+
+# Split a decimation factor into stage factors <= max_stage_factor, largest first.
+# Returns None if the factor has a larger prime factor
+def stage_factors(factor, max_stage_factor=10):
+    factors = []
+    while factor > 1:
+        for q in range(max_stage_factor, 1, -1):
+            if factor % q == 0:
+                factors.append(q)
+                factor //= q
+                break
+        else:
+            return None
+    return factors
+
+
+# Largest decimation factor that keeps `bandwidth` with an output rate of at least
+# margin * bandwidth and that splits into stages of factor <= max_stage_factor
+def decimation_factor(sample_rate, bandwidth, margin=2.5, max_stage_factor=10):
+    factor = max(1, int(sample_rate / (margin * bandwidth)))
+    while stage_factors(factor, max_stage_factor) is None:
+        factor -= 1
+    return factor
+
+
+class _Stage:
+    def __init__(self, taps, factor):
+        self.taps = taps
+        self.factor = factor
+        # Samples before the next output that it depends on, rounded to whole output periods
+        self.lead = -(-(len(taps) - 1) // factor) * factor
+        self.history = None
+
+    def update(self, x):
+        taps = self.taps.astype(x.dtype, copy=False)
+        if self.history is None:
+            # Start from a constant signal to avoid a step at the first sample
+            self.history = np.repeat(x[..., :1], self.lead, axis=-1)
+        data = np.concatenate((self.history, x), axis=-1)
+        # Outputs at data[lead], data[lead + factor], ...
+        n_out = max(0, (data.shape[-1] - self.lead - 1) // self.factor + 1)
+        first = self.lead // self.factor
+        y = upfirdn(taps, data, down=self.factor, axis=-1)[..., first:first + n_out]
+        self.history = data[..., n_out * self.factor:]
+        return y
+
+
+# Streaming decimator keeping `bandwidth` (Hz) of a signal sampled at sample_rate.
+# update() takes consecutive chunks (time along the last axis) and returns the decimated
+# samples; output_rate is the new sample rate and delay the group delay in seconds
+class Decimator:
+    def __init__(self, sample_rate, bandwidth, factor=None, max_stage_factor=10, attenuation_db=80, margin=2.5):
+        if factor is None:
+            factor = decimation_factor(sample_rate, bandwidth, margin, max_stage_factor)
+        factors = stage_factors(factor, max_stage_factor)
+        if factors is None:
+            raise ValueError(f'decimation factor {factor} does not split into stages <= {max_stage_factor}')
+        self.sample_rate = sample_rate
+        self.bandwidth = bandwidth
+        self.factor = factor
+        self.factors = factors
+        self.output_rate = sample_rate / factor
+        self.delay = 0.0
+        self.stages = []
+        rate = sample_rate
+        for q in factors:
+            output_rate = rate / q
+            if output_rate <= 2 * bandwidth:
+                raise ValueError(f'output rate {output_rate} Hz is too low for a bandwidth of {bandwidth} Hz')
+            # Everything above output_rate - bandwidth would alias into the band
+            n_taps, beta = kaiserord(attenuation_db, (output_rate - 2 * bandwidth) / (rate / 2))
+            n_taps |= 1  # odd length, delay of a whole number of samples
+            taps = firwin(n_taps, output_rate / 2, window=('kaiser', beta), fs=rate)
+            self.stages.append(_Stage(taps, q))
+            self.delay += (n_taps - 1) / 2 / rate
+            rate = output_rate
+
+    def reset(self):
+        for stage in self.stages:
+            stage.history = None
+
+    # float32 input stays float32, anything else is decimated in double precision
+    def update(self, chunk):
+        y = np.asarray(chunk)
+        if y.dtype != np.float32:
+            y = y.astype('double', copy=False)
+        for stage in self.stages:
+            y = stage.update(y)
+        return y
+
+
+# Decimator for the drive frequency and its first n_harmonics harmonics
+def drive_decimator(sample_rate, drive_frequency, n_harmonics=5, **kwargs):
+    return Decimator(sample_rate, drive_bandwidth(drive_frequency, n_harmonics), **kwargs)
+
+
+# Decimate a whole array chunk by chunk. Returns the decimated array and its sample rate
+def decimate(x, sample_rate, bandwidth, chunk_size=2 ** 20, **kwargs):
+    decimator = Decimator(sample_rate, bandwidth, **kwargs)
+    x = np.asarray(x)
+    parts = [decimator.update(x[..., start:start + chunk_size]) for start in range(0, x.shape[-1], chunk_size)]
+    return np.concatenate(parts, axis=-1), decimator.output_rate
+
+
+# Decimate a (sample_rate, data) chunk source as in psd.py, yields (output_rate, data)
+def decimate_chunks(chunks, bandwidth, **kwargs):
+    decimator = None
+    for sample_rate, data in chunks:
+        if decimator is None:
+            decimator = Decimator(sample_rate, bandwidth, **kwargs)
+        yield decimator.output_rate, decimator.update(data)
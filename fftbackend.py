@@ -0,0 +1,89 @@
+import collections
+import functools
+import os
+import numpy as np
+from scipy import fft as sp_fft
+
+# Spectral backend shared by the analysis scripts. The same trace lengths are transformed
+# hundreds of times per sweep, so plans and frequency axes are kept per length. With
+# pyFFTW installed the plans are explicit FFTW plans with their own aligned input and
+# output arrays; otherwise scipy.fft is used with all cores (it keeps its own plan cache
+# per length).
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+WORKERS = os.cpu_count() or 1
+MAX_PLANS = 8  # FFTW plans kept, each holds its input and output arrays
+
+_plans = collections.OrderedDict()
+
+
+# Smallest length >= n that factors into small primes, for zero-padded transforms
+@functools.lru_cache(maxsize=None)
+def fast_length(n, real=True):
+    return sp_fft.next_fast_len(n, real=real)
+
+
+@functools.lru_cache(maxsize=64)
+def rfftfreq(n, d=1.0):
+    frequencies = sp_fft.rfftfreq(n, d)
+    frequencies.flags.writeable = False
+    return frequencies
+
+
+# FFTW plan per shape, dtype, length and axis; the least recently used ones are dropped
+def _fftw_plan(shape, dtype, n, axis):
+    key = (shape, np.dtype(dtype).str, n, axis)
+    if key in _plans:
+        _plans.move_to_end(key)
+    else:
+        template = pyfftw.empty_aligned(shape, dtype=dtype)
+        _plans[key] = pyfftw.builders.rfft(template, n=n, axis=axis, threads=WORKERS,
+                                           planner_effort='FFTW_MEASURE', avoid_copy=False)
+        while len(_plans) > MAX_PLANS:
+            _plans.popitem(last=False)
+    return _plans[key]
+
+
+# Release the FFTW plans and cached frequency axes
+def clear_cache():
+    _plans.clear()
+    rfftfreq.cache_clear()
+
+
+# Real-input FFT along `axis` (2-D input transforms every row/column in one batched call).
+# n pads or crops as in numpy (n=fast_length(...) for a zero-padded fast transform).
+# With FFTW, reuse=True returns the output array of the plan itself, which the next call
+# with the same shape overwrites (copy the result if it must be kept); scipy allocates
+# every result anyway, so there it has no effect
+def rfft(x, n=None, axis=-1, reuse=False):
+    x = np.asarray(x)
+    if x.dtype not in (np.float32, np.float64):
+        x = x.astype(np.float64)
+    length = x.shape[axis] if n is None else n
+
+    if pyfftw is not None:
+        # The input is copied into the aligned array of the plan; the result is in its
+        # aligned output array
+        plan = _fftw_plan(x.shape, x.dtype, length, axis)
+        result = plan(input_array=x)
+        return result if reuse else result.copy()
+
+    return sp_fft.rfft(x, n=length, axis=axis, workers=WORKERS)
+
+
+def irfft(spectrum, n=None, axis=-1):
+    return sp_fft.irfft(spectrum, n=n, axis=axis, workers=WORKERS)
+
+
+# One-sided magnitude spectrum normalised like the scripts' np.abs(np.fft.fft(x)) / N
+def magnitude_spectrum(x, d, reuse=True):
+    x = np.asarray(x)
+    n = x.shape[-1]
+    spectrum = rfft(x, reuse=reuse)
+    magnitude = np.abs(spectrum)
+    magnitude /= n
+    return rfftfreq(n, d), magnitude
@@ -1,21 +1,19 @@
 import time
 import numpy as np
 import matplotlib.pyplot as plt
-import pyvisa
+from instrument_server import open_instrument
 from scipy.fft import fft, fftfreq
 from scipy.signal import find_peaks
 
-# Initialize VISA resource manager and list available instruments
-rm = pyvisa.ResourceManager()
-instruments = rm.list_resources()
-print(f"Connected instruments: {instruments}")
+# Instruments are opened through the instrument server if it is running (see
+# instrument_server.py), otherwise directly without scanning the network
 
 # Define the function generator IP address
 funcgen_ip = '192.168.1.4'  # Replace with the actual IP address
 funcgen_name = f'TCPIP0::{funcgen_ip}::INSTR'
 
 # Open the connection to the function generator
-funcgen = rm.open_resource(funcgen_name)
+funcgen = open_instrument(funcgen_name)
 funcgen.write_termination = '\n'
 funcgen.read_termination = '\n'
 
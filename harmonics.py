@@ -0,0 +1,116 @@
+import numpy as np
+import fftbackend
+
+
+def table_dtype(n_harmonics):
+    return np.dtype([
+        ('amplitude', 'f8'),  # drive amplitude (V)
+        ('frequency', 'f8'),  # drive frequency (Hz)
+        ('fundamental_frequency', 'f8'),  # measured frequency of the fundamental (Hz)
+        ('harmonics', 'f8', (n_harmonics,)),  # amplitudes of the fundamental and its harmonics, NaN above Nyquist
+        ('thd', 'f8'),  # total harmonic distortion, sqrt(sum A2..AN^2) / A1 over the harmonics below Nyquist
+        ('sinad_db', 'f8'),  # fundamental power over everything else (dB)
+        ('peak_ratio', 'f8'),  # A1 / A2
+        ('phase', 'f8'),  # phase of the fundamental at the first sample (rad, cosine reference)
+    ])
+
+
+# Harmonic analysis of a batch of equal-length traces (points x samples) with known drive
+# frequencies. All traces go through one windowed rfft; every harmonic is located within
+# a few bins of k * f0 and corrected for the Hann window's scalloping by interpolating
+# between the two largest bins (the phase is corrected for the fractional offset too).
+# window='rect' reads the exact bins instead, which is right for coherently sampled
+# captures (an integer number of drive cycles). Harmonics that do not fit below the
+# Nyquist frequency are NaN. Returns a structured array with one row per trace (see
+# table_dtype)
+def analyse_harmonics(traces, sample_rate, drive_frequencies, n_harmonics=5, window='hann',
+                      amplitudes=None, search_bins=2):
+    traces = np.atleast_2d(np.asarray(traces))
+    if traces.dtype != np.float32:
+        traces = traces.astype('double', copy=False)
+    n_points, n_samples = traces.shape
+    drive_frequencies = np.broadcast_to(np.asarray(drive_frequencies, dtype='double'), (n_points,))
+    bin_width = sample_rate / n_samples
+
+    if window == 'hann':
+        weights = np.hanning(n_samples).astype(traces.dtype)
+        spectrum = fftbackend.rfft((traces - traces.mean(axis=1, keepdims=True)) * weights, axis=1)
+    elif window == 'rect':
+        weights = np.ones(n_samples, dtype=traces.dtype)
+        spectrum = fftbackend.rfft(traces - traces.mean(axis=1, keepdims=True), axis=1)
+    else:
+        raise ValueError(f"window must be 'hann' or 'rect', not {window!r}")
+    magnitude = np.abs(spectrum)
+    n_bins = magnitude.shape[1]
+    rows = np.arange(n_points)[:, np.newaxis]
+
+    expected = np.outer(drive_frequencies, np.arange(1, n_harmonics + 1)) / bin_width
+    # The Hann interpolation needs the bin above the peak
+    in_band = expected <= (n_bins - 2 if window == 'hann' else n_bins - 1)
+    if window == 'hann':
+        # Largest bin around each expected harmonic
+        offsets = np.arange(-search_bins, search_bins + 1)
+        candidates = np.clip(np.rint(expected)[:, :, np.newaxis].astype(int) + offsets, 1, n_bins - 2)
+        values = magnitude[rows[:, :, np.newaxis], candidates]
+        peak = np.take_along_axis(candidates, values.argmax(axis=2)[:, :, np.newaxis], axis=2)[:, :, 0]
+
+        # Fractional bin offset from the larger neighbour (Hann window interpolation)
+        centre = magnitude[rows, peak]
+        left = magnitude[rows, peak - 1]
+        right = magnitude[rows, peak + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(right > left, right, left) / centre
+            delta = np.where(right > left, 1, -1) * (2 * ratio - 1) / (ratio + 1)
+            delta = np.nan_to_num(np.clip(delta, -0.5, 0.5))
+            correction = np.where(delta == 0, 1, np.pi * delta * (1 - delta ** 2) / np.sin(np.pi * delta))
+        harmonic_amplitudes = 2 * centre * correction / weights.sum(dtype='double')
+        fundamental_frequency = (peak[:, 0] + delta[:, 0]) * bin_width
+        # The symmetric Hann window adds a linear phase of pi * delta * (N - 1) / N
+        phase = np.angle(spectrum[rows[:, 0], peak[:, 0]]) - np.pi * delta[:, 0] * (n_samples - 1) / n_samples
+        phase = np.angle(np.exp(1j * phase))
+    else:
+        peak = np.clip(np.rint(expected).astype(int), 0, n_bins - 1)
+        harmonic_amplitudes = 2 * magnitude[rows, peak] / weights.sum(dtype='double')
+        fundamental_frequency = peak[:, 0] * bin_width
+        phase = np.angle(spectrum[rows[:, 0], peak[:, 0]])
+
+    # SINAD from the spectrum power: the fundamental's main lobe against all other bins above DC
+    power = magnitude ** 2
+    lobe = 3 if window == 'hann' else 0
+    bins = np.arange(n_bins)
+    fundamental_bins = np.abs(bins - peak[:, :1]) <= lobe
+    above_dc = bins > lobe
+    fundamental_power = np.where(fundamental_bins, power, 0).sum(axis=1)
+    rest_power = np.where(above_dc & ~fundamental_bins, power, 0).sum(axis=1)
+
+    harmonic_amplitudes = np.where(in_band, harmonic_amplitudes, np.nan)
+    fundamental_frequency = np.where(in_band[:, 0], fundamental_frequency, np.nan)
+    phase = np.where(in_band[:, 0], phase, np.nan)
+
+    table = np.zeros(n_points, dtype=table_dtype(n_harmonics))
+    if amplitudes is not None:
+        table['amplitude'] = amplitudes
+    table['frequency'] = drive_frequencies
+    table['fundamental_frequency'] = fundamental_frequency
+    table['harmonics'] = harmonic_amplitudes
+    table['phase'] = phase
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['thd'] = np.sqrt(np.nansum(harmonic_amplitudes[:, 1:] ** 2, axis=1)) / harmonic_amplitudes[:, 0]
+        table['sinad_db'] = np.where(in_band[:, 0], 10 * np.log10(fundamental_power / rest_power), np.nan)
+        if n_harmonics > 1:
+            table['peak_ratio'] = harmonic_amplitudes[:, 0] / harmonic_amplitudes[:, 1]
+    return table
+
+
+# Write a harmonic table as comma separated text, one column per harmonic. A path is
+# overwritten; an open file (e.g. in append mode across a sweep) only gets the header if
+# nothing has been written to it yet
+def write_table(table, file_path):
+    n_harmonics = table.dtype['harmonics'].shape[0]
+    columns = np.column_stack((table['amplitude'], table['frequency'], table['fundamental_frequency'],
+                               table['harmonics'], table['thd'], table['sinad_db'], table['peak_ratio'], table['phase']))
+    header = ', '.join(['amplitude', 'frequency', 'fundamental_frequency']
+                       + [f'H{k}' for k in range(1, n_harmonics + 1)] + ['thd', 'sinad_db', 'peak_ratio', 'phase'])
+    if hasattr(file_path, 'write') and file_path.tell() > 0:
+        header = ''
+    np.savetxt(file_path, columns, delimiter=', ', header=header, fmt='%.10g')
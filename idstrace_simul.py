@@ -2,21 +2,24 @@ import pyvisa
 import numpy as np
 import time
 import matplotlib.pyplot as plt
+from instrument_server import open_instrument, InstrumentServerError
+from archive import WaveformArchive, scaling_keys
+from transfer import transfer_waveform
+import fftbackend
 
-# Initialize the resource manager and connect to the oscilloscope
-rm = pyvisa.ResourceManager()
-instruments = rm.list_resources()
-print(f"Connected instruments: {instruments}")
+# Instruments are opened through the instrument server if it is running (see
+# instrument_server.py), otherwise directly without scanning the network
 
 oscilloscope_ip = '192.168.1.10'
 scope_name = f'TCPIP0::{oscilloscope_ip}::INSTR'
-scope = rm.open_resource(scope_name)
+scope = open_instrument(scope_name)
 scope.timeout = 100000  # Increase timeout to 100 seconds
 scope.read_termination = '\n'
 scope.write_termination = None
 scope.write('*cls')
 channels = ['CH1', 'CH2', 'CH3','CH4']
-print(scope.query('*idn?'))
+scope_idn = scope.query('*idn?')
+print(scope_idn)
 
 # Define settings for each channel
 channel_settings = {
@@ -71,6 +74,11 @@ scope.write('data:encdg SRIBINARY')
 scope.write('data:start 1')
 scope.write('wfmoutpre:byt_n 1')
 
+# Chunked transfer of every record into the memory-mapped file ids_<channel>_<time>.npy in
+# windows of transfer_chunk_size samples (see transfer.py); None uses one curve? per channel
+transfer_chunk_size = None
+transfer_stamp = time.strftime('%Y%m%d_%H%M%S')
+
 scope.write('acquire:state 0')
 scope.write('acquire:stopafter SEQUENCE')
 scope.write('acquire:state 1')
@@ -79,12 +87,14 @@ print("Starting acquisition...")
 t5 = time.perf_counter()
 try:
     r = scope.query('*opc?')
-except pyvisa.errors.VisaIOError as e:
+except (pyvisa.errors.VisaIOError, InstrumentServerError) as e:
     print(f"Timeout error during acquisition: {e}")
 t6 = time.perf_counter()
 print('acquire time: {} s'.format(t6 - t5))
 
 waveforms = {}
+raw_codes = {}
+raw_scaling = {}
 
 # Transfer waveform data from the oscilloscope for each channel
 for channel, settings in channel_settings.items():
@@ -97,7 +107,10 @@ for channel, settings in channel_settings.items():
     scope.write(f'data:stop {record_length}')
 
     t7 = time.perf_counter()
-    bin_wave = scope.query_binary_values('curve?', datatype='b', container=np.array)
+    if transfer_chunk_size is None:
+        bin_wave = scope.query_binary_values('curve?', datatype='b', container=np.array)
+    else:
+        bin_wave = transfer_waveform(scope, record_length, f'ids_{channel}_{transfer_stamp}.npy', transfer_chunk_size)
     t8 = time.perf_counter()
     print(f'transfer time for {channel}: {t8 - t7} s')
 
@@ -107,6 +120,8 @@ for channel, settings in channel_settings.items():
     vscale = float(scope.query('wfmoutpre:ymult?'))
     voff = float(scope.query('wfmoutpre:yzero?'))
     vpos = float(scope.query('wfmoutpre:yoff?'))
+    raw_codes[channel] = bin_wave
+    raw_scaling[channel] = dict(zip(scaling_keys, (tscale, tstart, vscale, voff, vpos)))
 
     # Create scaled vectors for the time-domain plot
     total_time = tscale * record_length
@@ -122,7 +137,11 @@ for channel, settings in channel_settings.items():
 
 # Close the oscilloscope connection
 scope.close()
-rm.close()
+
+# Archive the raw codes of all channels together with their scaling
+with WaveformArchive('raw_captures.h5') as archive:
+    archive.write_capture(f'ids_{time.strftime("%Y%m%d_%H%M%S")}', raw_codes, raw_scaling,
+                          scope_idn=scope_idn, factor=factor)
 
 # Calculate the total sine and total cosine
 
@@ -153,9 +172,7 @@ if 'CH1' in waveforms and 'CH2' in waveforms and 'CH3' in waveforms and 'CH4' in
     plt.show()
 
     # Perform FFT on the arctangent result
-    fft_result = np.fft.fft(result)
-    fft_freq = np.fft.fftfreq(len(result), d=tscale)
-    fft_magnitude = np.abs(fft_result) / len(result)
+    fft_freq, fft_magnitude = fftbackend.magnitude_spectrum(result, tscale)
 
     # Plot the FFT of the arctangent result
     plt.figure(figsize=(12, 6))
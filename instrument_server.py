@@ -0,0 +1,367 @@
+import base64
+import json
+import socket
+import socketserver
+import threading
+import numpy as np
+
+HOST = '127.0.0.1'
+PORT = 50200
+
+# Settings whose writes are cached and skipped if unchanged, in SCPI notation (upper case
+# part = short form, # = numeric suffix). Every entry lists all headers of one instrument
+# setting; they share the cache entry of the first, and a leading SOURce# may be omitted
+# (channel 1). Only settings that neither the instrument nor other settings change are
+# listed (not e.g. the record length, sample rate, channel scales or the data window);
+# everything else is always sent
+CACHED_SETTINGS = (
+    ('HEADer',),
+    ('DATa:SOUrce',),
+    ('DATa:ENCdg',),
+    ('WFMOutpre:BYT_Nr',),
+    ('SOURce#:FUNCtion', 'SOURce#:FUNCtion:SHAPe'),
+    ('SOURce#:FREQuency', 'SOURce#:FREQuency:FIXed', 'SOURce#:FREQuency:CW'),
+    ('SOURce#:VOLTage:AMPLitude', 'SOURce#:VOLTage', 'SOURce#:VOLTage:LEVel', 'SOURce#:VOLTage:LEVel:IMMediate',
+     'SOURce#:VOLTage:LEVel:IMMediate:AMPLitude'),
+)
+
+# Any other write below one of these roots can change cached settings of its group (e.g.
+# 'SOUR1:VOLT:HIGH' the amplitude, 'DATa INIT' the encoding) and drops them from the
+# cache. # takes the channel into the group; the SOURce children without SOURce are
+# channel 1
+SETTING_GROUPS = {
+    'SOURce#': 'SOURCE',
+    'FREQuency': 'SOURCE1',
+    'VOLTage': 'SOURCE1',
+    'FUNCtion': 'SOURCE1',
+    'PHASe': 'SOURCE1',
+    'PULSe': 'SOURCE1',
+    'DATa': 'DATA',
+    'WFMOutpre': 'DATA',
+    'HEADer': 'HEADER',
+}
+
+# Commands that change the whole instrument state (reset, recall, factory, autoset,
+# preset); they clear the cache
+STATE_COMMANDS = ('*RST', '*RCL', 'FAC', 'AUTOS', 'SYST:PRES', 'SYSTEM:PRES')
+
+
+class InstrumentServerError(RuntimeError):
+    pass
+
+
+def _mnemonic_forms(mnemonic):
+    base = mnemonic.rstrip('#')
+    short = ''.join(c for c in base if not c.islower())
+    return short.upper(), base.upper(), mnemonic.endswith('#')
+
+
+# Numeric suffix of a header node matching a mnemonic ('' if it has none), None if the
+# node does not match
+def _match_node(node, mnemonic):
+    short, long, has_suffix = _mnemonic_forms(mnemonic)
+    name = node.rstrip('0123456789')
+    if name not in (short, long) or (name != node and not has_suffix):
+        return None
+    return node[len(name):]
+
+
+# Canonical key of a header such as 'sour1:freq:fix' ('SOURCE1:FREQUENCY') if it sets one
+# of the CACHED_SETTINGS, so all spellings of a setting share one cache entry; else None
+def normalise_header(header):
+    nodes = header.lstrip(':').upper().split(':')
+    for setting in CACHED_SETTINGS:
+        for spelling in setting:
+            mnemonics = spelling.split(':')
+            variants = [mnemonics]
+            if mnemonics[0] == 'SOURce#':
+                variants.append(mnemonics[1:])
+            for variant in variants:
+                if len(variant) != len(nodes):
+                    continue
+                suffixes = [_match_node(node, mnemonic) for node, mnemonic in zip(nodes, variant)]
+                if None in suffixes:
+                    continue
+                canonical = [_mnemonic_forms(mnemonic)[1] for mnemonic in setting[0].split(':')]
+                if setting[0].startswith('SOURce#'):
+                    canonical[0] += (suffixes[0] if variant is mnemonics else '') or '1'
+                return ':'.join(canonical)
+    return None
+
+
+# Group of the settings a header can affect (see SETTING_GROUPS), None if it has none
+def setting_group(header):
+    node = header.lstrip(':').upper().split(':')[0]
+    for mnemonic, group in SETTING_GROUPS.items():
+        suffix = _match_node(node, mnemonic)
+        if suffix is not None:
+            return group + (suffix or '1') if mnemonic.endswith('#') else group
+    return None
+
+
+# Split a cached setting command such as 'SOUR1:FREQ 20' into its normalised header and
+# value; returns None for queries, common commands (*rst, *cls, ...), commands without
+# value, compound commands and settings that are not cached
+def parse_setting(command):
+    command = command.strip()
+    if not command or command.startswith('*') or '?' in command or ';' in command:
+        return None
+    parts = command.split(None, 1)
+    if len(parts) != 2:
+        return None
+    header = normalise_header(parts[0])
+    if header is None:
+        return None
+    return header, parts[1].strip()
+
+
+# One open VISA session with a cache of the settings written through the server.
+# Resources are opened directly by name, so no list_resources() network scan is needed.
+# Resets are always sent and clear the cache; other uncached writes drop the cached
+# settings of their group, compound commands (;) the whole cache
+class Session:
+    def __init__(self, rm, resource_name):
+        self.lock = threading.Lock()
+        self.resource = rm.open_resource(resource_name)
+        self.settings = {}
+
+    def write(self, command):
+        setting = parse_setting(command)
+        if setting is not None:
+            header, value = setting
+            # Only send settings that differ from what the instrument already has
+            if self.settings.get(header) == value:
+                return False
+            self.resource.write(command)
+            self.settings[header] = value
+            return True
+        stripped = command.strip()
+        if ';' in stripped or stripped.lstrip(':').upper().startswith(STATE_COMMANDS):
+            self.settings.clear()
+        elif stripped:
+            group = setting_group(stripped.split(None, 1)[0])
+            if group is not None:
+                for header in [header for header in self.settings if setting_group(header) == group]:
+                    del self.settings[header]
+        self.resource.write(command)
+        return True
+
+    def reset(self):
+        self.resource.write('*rst')
+        self.resource.query('*opc?')
+        self.settings.clear()
+
+
+# Long-lived state of the server: VISA sessions and the IDS connection, opened on first use
+class SessionManager:
+    def __init__(self):
+        import pyvisa
+        self.rm = pyvisa.ResourceManager()
+        self.sessions = {}
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def session(self, resource_name):
+        with self.lock:
+            if resource_name not in self.sessions:
+                self.sessions[resource_name] = Session(self.rm, resource_name)
+                print(f"Opened session to {resource_name}")
+            return self.sessions[resource_name]
+
+    def ids_device(self, ip):
+        with self.lock:
+            if ip not in self.ids:
+                import IDS
+                self.ids[ip] = IDS.Device(ip)
+                self.ids[ip].connect()
+                print(f"Connected to IDS at {ip}")
+            return self.ids[ip]
+
+    def handle(self, request):
+        op = request['op']
+        if op == 'ids':
+            target = self.ids_device(request['ip'])
+            for attribute in request['method'].split('.'):
+                target = getattr(target, attribute)
+            result = target(*request.get('args', []), **request.get('kwargs', {}))
+            try:
+                json.dumps(result)
+            except TypeError:
+                result = repr(result)
+            return result
+
+        session = self.session(request['instrument'])
+        with session.lock:
+            if op == 'write':
+                return session.write(request['command'])
+            if op == 'query':
+                return session.resource.query(request['command'])
+            if op == 'query_binary':
+                dtype = np.dtype(request.get('datatype', 'b'))
+                values = session.resource.query_binary_values(request['command'], datatype=request.get('datatype', 'b'),
+                                                               container=np.array)
+                return base64.b64encode(np.asarray(values, dtype=dtype).tobytes()).decode('ascii')
+            if op == 'set_attribute':
+                setattr(session.resource, request['attribute'], request['value'])
+                return None
+            if op == 'reset':
+                session.reset()
+                return None
+            if op == 'settings':
+                return session.settings
+        raise InstrumentServerError(f'unknown operation {op!r}')
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {'result': self.server.manager.handle(json.loads(line))}
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class InstrumentServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=(HOST, PORT)):
+        super().__init__(address, RequestHandler)
+        self.manager = SessionManager()
+
+
+# Client side: one socket to the server shared by the proxies below
+class InstrumentClient:
+    def __init__(self, host=HOST, port=PORT, timeout=1):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.settimeout(None)
+        self.file = self.sock.makefile('rwb')
+        self.lock = threading.Lock()
+
+    def request(self, **request):
+        with self.lock:
+            self.file.write(json.dumps(request).encode() + b'\n')
+            self.file.flush()
+            response = json.loads(self.file.readline())
+        if 'error' in response:
+            raise InstrumentServerError(response['error'])
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+# Stand-in for a pyvisa resource that goes through the server
+class RemoteResource:
+    def __init__(self, client, name):
+        self.__dict__['client'] = client
+        self.__dict__['name'] = name
+        # Make sure the session exists before the first command
+        self.client.request(op='settings', instrument=name)
+
+    def __setattr__(self, attribute, value):
+        # timeout and terminations are applied to the session kept by the server
+        self.client.request(op='set_attribute', instrument=self.name, attribute=attribute, value=value)
+
+    def write(self, command):
+        self.client.request(op='write', instrument=self.name, command=command)
+
+    def query(self, command):
+        return self.client.request(op='query', instrument=self.name, command=command)
+
+    def query_binary_values(self, command, datatype='b', container=list):
+        data = self.client.request(op='query_binary', instrument=self.name, command=command, datatype=datatype)
+        values = np.frombuffer(base64.b64decode(data), dtype=np.dtype(datatype))
+        return values.copy() if container is np.array else container(values)
+
+    def reset(self):
+        self.client.request(op='reset', instrument=self.name)
+
+    # The session stays open in the server
+    def close(self):
+        pass
+
+
+# Stand-in for IDS.Device: attribute chains such as ids.streaming.open(...) are
+# forwarded to the device connected in the server
+class RemoteIDS:
+    def __init__(self, client, ip, path=''):
+        self._client = client
+        self._ip = ip
+        self._path = path
+
+    def __getattr__(self, attribute):
+        return RemoteIDS(self._client, self._ip, f'{self._path}.{attribute}' if self._path else attribute)
+
+    def __call__(self, *args, **kwargs):
+        return self._client.request(op='ids', ip=self._ip, method=self._path, args=list(args), kwargs=kwargs)
+
+    # The connection stays open in the server
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+_client = None
+_rm = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        try:
+            _client = InstrumentClient()
+        except OSError:
+            return None
+        print("Attached to instrument server")
+    return _client
+
+
+# Open a VISA resource through the session server if it is running, otherwise directly
+# (still without scanning the network)
+def open_instrument(resource_name):
+    global _rm
+    client = _get_client()
+    if client is not None:
+        return RemoteResource(client, resource_name)
+    import pyvisa
+    if _rm is None:
+        _rm = pyvisa.ResourceManager()
+    return _rm.open_resource(resource_name)
+
+
+# Open the IDS through the session server if it is running, otherwise directly
+def open_ids(ip):
+    client = _get_client()
+    if client is not None:
+        return RemoteIDS(client, ip)
+    import IDS
+    ids = IDS.Device(ip)
+    ids.connect()
+    return ids
+
+
+def main():
+    server = InstrumentServer()
+    print(f"Instrument server listening on {HOST}:{PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for session in server.manager.sessions.values():
+            session.resource.close()
+        for ids in server.manager.ids.values():
+            ids.close()
+        server.manager.rm.close()
+    print("\nEnd")
+
+
+if __name__ == '__main__':
+    main()
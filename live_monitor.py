@@ -0,0 +1,178 @@
+import sys
+import threading
+import time
+import numpy as np
+
+
+# Rolling statistics over the last `window` samples of a live stream, kept in a ring
+# buffer. The mean, RMS and the amplitude at the drive frequency are updated with
+# running sums (a sliding DFT for the drive frequency), so every new sample costs O(1)
+# however long the window is. The sums are recomputed from the buffer once per window
+# to stop rounding errors from accumulating.
+class RollingMonitor:
+    def __init__(self, sample_rate, window_time=1.0, drive_frequency=None,
+                 clip_level=None, max_step=None, min_drive=None):
+        self.sample_rate = sample_rate
+        self.window = max(1, int(window_time * sample_rate))
+        self.clip_level = clip_level  # |x| at or above this counts as saturated
+        self.max_step = max_step  # a larger jump between samples counts as lost fringe
+        self.min_drive = min_drive  # a smaller drive amplitude counts as missing drive
+        self.lock = threading.Lock()
+        self.reset(drive_frequency)
+
+    def reset(self, drive_frequency=None):
+        with self.lock:
+            self.drive_frequency = drive_frequency
+            self.buffer = np.zeros(self.window)
+            self.n_samples = 0
+            self.sum = 0.0
+            self.sum_squares = 0.0
+            self.sum_drive = 0j
+            self.since_refresh = 0
+            self.last = None
+            self.n_saturated = 0
+            self.n_jumps = 0
+
+    def _reference(self, index):
+        if self.drive_frequency is None:
+            return np.zeros(len(index))
+        cycles = np.mod(self.drive_frequency * index, self.sample_rate) / self.sample_rate
+        return np.exp(-2j * np.pi * cycles)
+
+    def _refresh(self):
+        filled = min(self.n_samples, self.window)
+        index = np.arange(self.n_samples - filled, self.n_samples)
+        values = self.buffer[index % self.window]
+        self.sum = values.sum()
+        self.sum_squares = np.dot(values, values)
+        self.sum_drive = np.dot(values, self._reference(index))
+        self.since_refresh = 0
+
+    def update(self, samples):
+        samples = np.asarray(samples, dtype='double').ravel()
+        with self.lock:
+            # Fault counters look at every sample, not only the ones still in the window
+            if self.clip_level is not None:
+                self.n_saturated += int(np.count_nonzero(np.abs(samples) >= self.clip_level))
+            if self.max_step is not None and len(samples):
+                previous = samples[0] if self.last is None else self.last
+                steps = np.abs(np.diff(samples, prepend=previous))
+                self.n_jumps += int(np.count_nonzero(~(steps <= self.max_step)))
+                self.last = samples[-1]
+
+            for start in range(0, len(samples), self.window):
+                self._push(samples[start:start + self.window])
+        return self
+
+    # Add at most one window of samples, removing the ones they overwrite
+    def _push(self, new):
+        index = self.n_samples + np.arange(len(new))
+        slots = index % self.window
+        old = self.buffer[slots]
+        old_valid = index >= self.window
+        old = np.where(old_valid, old, 0.0)
+
+        self.sum += new.sum() - old.sum()
+        self.sum_squares += np.dot(new, new) - np.dot(old, old)
+        self.sum_drive += np.dot(new, self._reference(index)) - np.dot(old, self._reference(index - self.window))
+
+        self.buffer[slots] = new
+        self.n_samples += len(new)
+        self.since_refresh += len(new)
+        if self.since_refresh >= self.window:
+            self._refresh()
+
+    def stats(self):
+        with self.lock:
+            filled = min(self.n_samples, self.window)
+            if filled == 0:
+                return {'mean': 0.0, 'rms': 0.0, 'drive': 0.0, 'filled': 0.0}
+            mean = self.sum / filled
+            variance = max(self.sum_squares / filled - mean ** 2, 0.0)
+            # rms is taken about the rolling mean
+            return {
+                'mean': mean,
+                'rms': np.sqrt(variance),
+                'drive': 2 * abs(self.sum_drive) / filled,
+                'filled': filled / self.window,
+            }
+
+    # Problems seen since the last reset; an empty list means the point looks good
+    def faults(self):
+        faults = []
+        if self.n_saturated:
+            faults.append(f'saturation ({self.n_saturated} samples)')
+        if self.n_jumps:
+            faults.append(f'lost fringe ({self.n_jumps} jumps)')
+        stats = self.stats()
+        if self.min_drive is not None and self.drive_frequency is not None and stats['filled'] >= 1:
+            if stats['drive'] < self.min_drive:
+                faults.append(f"missing drive ({stats['drive']:.3g} < {self.min_drive:.3g})")
+        return faults
+
+    def status_line(self):
+        stats = self.stats()
+        faults = self.faults()
+        line = f"mean {stats['mean']:+.4g}  rms {stats['rms']:.4g}"
+        if self.drive_frequency is not None:
+            line += f"  {self.drive_frequency} Hz {stats['drive']:.4g}"
+        return line + ('  ' + ', '.join(faults) if faults else '  ok')
+
+
+# Print the status of the monitors on one terminal line, refreshed at `rate` Hz,
+# until the returned event is set
+def terminal_view(monitors, rate=4):
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(1 / rate):
+            line = ' | '.join(f'{name}: {monitor.status_line()}' for name, monitor in monitors.items())
+            sys.stdout.write('\r' + line + '\033[K')
+            sys.stdout.flush()
+        sys.stdout.write('\n')
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
+# Poll the IDS displacement into a monitor in a background thread until the returned
+# event is set. Polling is limited by the network round trip, so it catches lost fringes
+# and drifts; the drive amplitude needs the audio tap or the streamed data
+def ids_tap(ids, monitor, axis=0, poll_rate=100):
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(1 / poll_rate):
+            warning, *positions = ids.displacement.getAbsolutePositions()
+            monitor.update([positions[axis]])
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
+# Monitor the audio input live (python live_monitor.py <drive frequency>)
+def main(drive_frequency=None):
+    import sounddevice as sd
+
+    device_id = 1
+    sample_rate = 44100
+    channel = 0
+
+    monitor = RollingMonitor(sample_rate, window_time=1.0, drive_frequency=drive_frequency,
+                             clip_level=0.99, min_drive=1e-3 if drive_frequency else None)
+
+    def callback(indata, frames, time_info, status):
+        monitor.update(indata[:, channel])
+
+    stop = terminal_view({'audio': monitor})
+    with sd.InputStream(device=device_id, samplerate=sample_rate, channels=2, dtype='float32', callback=callback):
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    stop.set()
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else None)
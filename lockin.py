@@ -0,0 +1,127 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from scipy.signal import butter, sosfilt
+from catalog import sweep_files
+
+
+# Digital lock-in amplifier working on consecutive chunks of one signal.
+# The signal is mixed with cos/sin references at the drive frequency and its harmonics,
+# low-pass filtered (filter state carried between chunks) and decimated to output_rate,
+# so memory only depends on the chunk size and drift inside a capture stays visible.
+class LockIn:
+    def __init__(self, sample_rate, drive_frequency, n_harmonics=1, output_rate=10, cutoff=None, order=4):
+        self.sample_rate = sample_rate
+        self.drive_frequency = drive_frequency
+        self.harmonics = drive_frequency * np.arange(1, n_harmonics + 1)
+        self.decimation = max(1, int(round(sample_rate / output_rate)))
+        self.output_rate = sample_rate / self.decimation
+        # Stay well below the output Nyquist frequency and the drive frequency
+        if cutoff is None:
+            cutoff = min(self.output_rate / 4, drive_frequency / 4)
+        self.cutoff = cutoff
+        self.sos = butter(order, cutoff, fs=sample_rate, output='sos')
+        # One filter state per I and Q channel of every harmonic
+        self.zi = np.zeros((self.sos.shape[0], 2 * n_harmonics, 2))
+        self.n_samples = 0
+
+    # Time (s) the filter needs before the output is settled (about 5 time constants)
+    @property
+    def settling_time(self):
+        return 5 / (2 * np.pi * self.cutoff)
+
+    # Process one chunk; returns the output times, the amplitude and the phase (radians,
+    # relative to a cosine at t = 0) of every harmonic, each of shape (n_harmonics, n_out)
+    def process(self, chunk):
+        chunk = np.asarray(chunk, dtype='double')
+        index = self.n_samples + np.arange(len(chunk))
+
+        # Reference phase from the absolute sample index, wrapped before scaling so it
+        # stays exact for arbitrarily long recordings
+        cycles = np.mod(np.outer(self.harmonics, index), self.sample_rate) / self.sample_rate
+        phase = 2 * np.pi * cycles
+        mixed = np.vstack((chunk * np.cos(phase), -chunk * np.sin(phase)))
+        filtered, self.zi = sosfilt(self.sos, mixed, axis=-1, zi=self.zi)
+
+        # Keep the samples on the global decimation grid
+        first = (-self.n_samples) % self.decimation
+        kept = filtered[:, first::self.decimation]
+        times = index[first::self.decimation] / self.sample_rate
+        self.n_samples += len(chunk)
+
+        n_harmonics = len(self.harmonics)
+        in_phase = kept[:n_harmonics]
+        quadrature = kept[n_harmonics:]
+        amplitude = 2 * np.hypot(in_phase, quadrature)
+        return times, amplitude, np.arctan2(quadrature, in_phase)
+
+
+# Run the lock-in over a whole array in chunks and concatenate the outputs
+def demodulate(signal, sample_rate, drive_frequency, n_harmonics=1, output_rate=10, chunk_size=100000, **kwargs):
+    lockin = LockIn(sample_rate, drive_frequency, n_harmonics, output_rate, **kwargs)
+    outputs = [lockin.process(signal[i:i + chunk_size]) for i in range(0, len(signal), chunk_size)]
+    times, amplitude, phase = (np.concatenate(parts, axis=-1) for parts in zip(*outputs))
+    return times, amplitude, phase
+
+
+# Convert a displacement amplitude in pm at the given frequencies to acceleration in m/s^2
+def displacement_to_acceleration(amplitude, frequencies):
+    return amplitude * (2 * np.pi * np.asarray(frequencies)[:, np.newaxis]) ** 2 * 1e-12
+
+
+def main(run_id=None):
+    n_harmonics = 3
+    output_rate = 10  # Hz
+    chunk_size = 100000  # rows read from the csv at a time
+
+    for rounded_amplitude, rounded_frequency, file_path in sweep_files('csv', run_id):
+        if not os.path.isfile(file_path):
+            print(f"File not found: {file_path}")
+            continue
+
+        lockin = None
+        offset = 0
+        outputs = []
+        reader = pd.read_csv(file_path, header=None, names=['Time', 'Pos0', 'Pos1', 'Pos2'],
+                             usecols=['Time', 'Pos0'], chunksize=chunk_size)
+        for data in reader:
+            if lockin is None:
+                sample_rate = 1 / (data['Time'].iloc[1] - data['Time'].iloc[0])
+                lockin = LockIn(sample_rate, rounded_frequency, n_harmonics, output_rate)
+                # Remove the absolute position so it does not leak through the filter
+                offset = data['Pos0'].iloc[0]
+            outputs.append(lockin.process(data['Pos0'].to_numpy() - offset))
+
+        if lockin is None:
+            continue
+        times, displacement, phase = (np.concatenate(parts, axis=-1) for parts in zip(*outputs))
+        acceleration = displacement_to_acceleration(displacement, lockin.harmonics)
+
+        # Ignore the filter start-up when summarising
+        settled = times >= lockin.settling_time
+        mean_displacement = displacement[:, settled].mean(axis=1)
+        drift = np.ptp(displacement[:, settled], axis=1)
+        mean_acceleration = acceleration[:, settled].mean(axis=1)
+        print(f"{rounded_amplitude} V, {rounded_frequency} Hz: displacement {mean_displacement} pm, "
+              f"drift {drift} pm, acceleration {mean_acceleration} m/s^2")
+
+        # Amplitude and phase time series of every harmonic
+        columns = {'Time': times}
+        for k in range(n_harmonics):
+            columns[f'Displacement{k + 1}'] = displacement[k]
+            columns[f'Acceleration{k + 1}'] = acceleration[k]
+            columns[f'Phase{k + 1}'] = phase[k]
+        pd.DataFrame(columns).to_csv(
+            os.path.join(os.path.dirname(file_path), f'lockin_{rounded_amplitude}_{rounded_frequency}.csv'), index=False)
+
+        with open('output_ids_lockin.txt', 'a') as file:
+            values = ', '.join(f'{d}, {a}, {p}' for d, a, p in zip(mean_displacement, mean_acceleration, drift))
+            file.write(f'{rounded_amplitude} V, {rounded_frequency} Hz, {values}\n')
+        print("\nLock-in results saved to output_ids_lockin.txt")
+
+    print("\nEnd")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
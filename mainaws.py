@@ -1,28 +1,25 @@
 import time
 import numpy as np
-import pyvisa
-import IDS
+from instrument_server import open_instrument, open_ids
+from catalog import RunCatalog
 import os
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 #print(script_dir)
 
 def main():
-    # Initialize VISA resource manager and list available instruments
-    rm = pyvisa.ResourceManager()
-    instruments = rm.list_resources()
-    print(f"Connected instruments: {instruments}")
+    # Instruments are opened through the instrument server if it is running (see
+    # instrument_server.py), otherwise directly without scanning the network
 
     # Configure the function generator 
     funcgen_ip = '192.168.1.4'
     funcgen_name = f'TCPIP0::{funcgen_ip}::INSTR'
-    funcgen = rm.open_resource(funcgen_name)
+    funcgen = open_instrument(funcgen_name)
     funcgen.write_termination = '\n'
     funcgen.read_termination = '\n'
 
     # Configure the IDS
-    ids = IDS.Device("192.168.1.1")
-    ids.connect()
+    ids = open_ids("192.168.1.1")
 
     # Define the initial parameters for the function generator
     initial_amplitude = 0.5  # Initial amplitude in volts (pp is the same)
@@ -33,6 +30,10 @@ def main():
     frequency_increment = 50  # Frequency increment in Hz
     channel_out = 1
 
+    # Every sweep is a new run in the catalog, with its own data directory
+    catalog = RunCatalog()
+    run_id = catalog.new_run('mainaws')
+
     for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_increment, amplitude_increment):
         for frequency in np.arange(initial_frequency, max_frequency + frequency_increment, frequency_increment):
             # Configure the function generator
@@ -49,14 +50,14 @@ def main():
             rounded_frequency = round(frequency, 2)
 
             # Construct the absolute path for the data file
-            data_file = os.path.join(script_dir, f"data_{rounded_amplitude}_{rounded_frequency}.aws")
+            data_file = catalog.data_file(run_id, rounded_amplitude, rounded_frequency, 'aws')
 
-            # Open a stream for axis0
-            stream = ids.streaming.open(True, 10, data_file, axis0=True)
+            # Open a stream for all three axes
+            stream = ids.streaming.open(True, 10, data_file, axis0=True, axis1=True, axis2=True)
             print(stream)
             
             # Start background streaming
-            ids.streaming.startBackgroundStreaming(True, 10, data_file, axis0=True)
+            ids.streaming.startBackgroundStreaming(True, 10, data_file, axis0=True, axis1=True, axis2=True)
             print("Background streaming started")
 
             time.sleep(10)
@@ -64,6 +65,7 @@ def main():
             # Stop the background stream
             ids.streaming.stopBackgroundStreaming()
             print(f"Background streaming stopped, data for {rounded_amplitude}V and {rounded_frequency}Hz saved to .aws file")
+            catalog.register(data_file, run_id, 'ids', rounded_amplitude, rounded_frequency, axis='axis0,axis1,axis2')
 
             # Turn off the output
             funcgen.write(f'OUTPUT{channel_out}:STATE OFF')
@@ -72,6 +74,7 @@ def main():
 
     print("\nEnd")
 
+    catalog.close()
     funcgen.close()
 
 if __name__ == '__main__':
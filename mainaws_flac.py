@@ -1,11 +1,11 @@
 import time
 import numpy as np
-import pyvisa
-import IDS
+from instrument_server import open_instrument, open_ids
 import os
 import sounddevice as sd
 import soundfile as sf
 from datetime import datetime
+from catalog import RunCatalog
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 #print(script_dir)
@@ -17,22 +17,19 @@ def list_devices():
         print(f"{index}: {device['name']} ({'input' if device['max_input_channels'] > 0 else 'output'})")
 
 def main():
-    # Initialize VISA resource manager and list available instruments
-    rm = pyvisa.ResourceManager()
-    instruments = rm.list_resources()
-    print(f"Connected instruments: {instruments}")
+    # Instruments are opened through the instrument server if it is running (see
+    # instrument_server.py), otherwise directly without scanning the network
 
     # Configure the function generator 
     funcgen_ip = '192.168.1.4'
     funcgen_name = f'TCPIP0::{funcgen_ip}::INSTR'
-    funcgen = rm.open_resource(funcgen_name)
+    funcgen = open_instrument(funcgen_name)
     funcgen.write_termination = '\n'
     funcgen.read_termination = '\n'
     funcgen.write('*CLS')
     
     # Configure the IDS
-    ids = IDS.Device("192.168.1.1")
-    ids.connect()
+    ids = open_ids("192.168.1.1")
 
     # Setting up audio device
     device_id = 1
@@ -66,6 +63,10 @@ def main():
     frequency_increment = 20  # Frequency increment in Hz
     channel_out = 1
 
+    # Every sweep is a new run in the catalog, with its own data directory
+    catalog = RunCatalog()
+    run_id = catalog.new_run('mainaws_flac')
+
     for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_increment, amplitude_increment):
         for frequency in np.arange(initial_frequency, max_frequency + frequency_increment, frequency_increment):
             # Configure the function generator
@@ -82,14 +83,14 @@ def main():
             rounded_frequency = round(frequency, 2)
 
             # Construct the absolute path for the data file
-            data_file = os.path.join(script_dir, f"data_{rounded_amplitude}_{rounded_frequency}.aws")
+            data_file = catalog.data_file(run_id, rounded_amplitude, rounded_frequency, 'aws')
 
-            # Open a stream for axis0
-            stream = ids.streaming.open(True, 10, data_file, axis0=True)
+            # Open a stream for all three axes
+            stream = ids.streaming.open(True, 10, data_file, axis0=True, axis1=True, axis2=True)
             print(stream)
             
             # Start background streaming
-            ids.streaming.startBackgroundStreaming(True, 10, data_file, axis0=True)
+            ids.streaming.startBackgroundStreaming(True, 10, data_file, axis0=True, axis1=True, axis2=True)
             print("Background streaming started")
 
             # Main recording
@@ -103,13 +104,15 @@ def main():
             ids.streaming.stopBackgroundStreaming()
             print(f"Background streaming stopped, data for {rounded_amplitude}V and {rounded_frequency}Hz saved to .aws file")
             print("Recording finished.")
+            catalog.register(data_file, run_id, 'ids', rounded_amplitude, rounded_frequency, axis='axis0,axis1,axis2')
 
             # Generate filename 
-            audio_file = os.path.join(script_dir, f"data_{rounded_amplitude}_{rounded_frequency}.flac")
+            audio_file = catalog.data_file(run_id, rounded_amplitude, rounded_frequency, 'flac')
 
             # Save the recorded audio
             sf.write(audio_file, audio, sample_rate)
             print(f"File saved as data_{rounded_amplitude}_{rounded_frequency}.flac")
+            catalog.register(audio_file, run_id, 'audio', rounded_amplitude, rounded_frequency, sample_rate=sample_rate)
 
             # Turn off the output
             funcgen.write(f'OUTPUT{channel_out}:STATE OFF')
@@ -118,8 +121,8 @@ def main():
 
     print("\nEnd")
 
+    catalog.close()
     funcgen.close()
-    rm.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,32 +1,41 @@
+import os
 import time
 import numpy as np
 import matplotlib.pyplot as plt
-import pyvisa
+from instrument_server import open_instrument
 from scipy.signal import find_peaks, butter, filtfilt
-
-# Initialize VISA resource manager and list available instruments
-rm = pyvisa.ResourceManager()
-instruments = rm.list_resources()
-print(f"Connected instruments: {instruments}")
+from archive import WaveformArchive, query_scaling, scale_codes, time_vector
+import fftbackend
+import harmonics
+from coherent import configure_sync_output, configure_external_trigger, configure_coherent_record
+from transfer import transfer_waveform
+from decimate import drive_decimator
+from catalog import RunCatalog, array_checksum
+from memory import MemoryTracker, work_dtype
+
+# Instruments are opened through the instrument server if it is running (see
+# instrument_server.py), otherwise directly without scanning the network
 
 # Define the function generator IP address
 funcgen_ip = '192.168.1.4'
 funcgen_name = f'TCPIP0::{funcgen_ip}::INSTR'
 # Open the connection to the function generator
-funcgen = rm.open_resource(funcgen_name)
+funcgen = open_instrument(funcgen_name)
 funcgen.write_termination = '\n'
 funcgen.read_termination = '\n'
 
 # Open the connection to the oscilloscope
 oscilloscope_ip = '192.168.1.10'
 scope_name = f'TCPIP0::{oscilloscope_ip}::INSTR'
-scope = rm.open_resource(scope_name)
+scope = open_instrument(scope_name)
 scope.timeout = 100000  # Increase timeout to 100 seconds
 scope.read_termination = '\n'
 scope.write_termination = None
 scope.write('*cls')
 channels = ['CH1', 'CH2', 'CH3', 'CH4']
-print(scope.query('*idn?'))
+scope_idn = scope.query('*idn?')
+print(scope_idn)
+funcgen_idn = funcgen.query('*IDN?')
 
 # Define settings for each channel
 channel_settings = {
@@ -37,6 +46,32 @@ channel_settings = {
 }
 desired_time_window = 11  # seconds
 
+# 'free': free-running captures of desired_time_window seconds
+# 'triggered': captures triggered by the sync output of the function generator (to the AUX
+# input of the scope) over an integer number of drive cycles of at least coherent_duration
+# and at most coherent_max_duration; points without such a record are skipped
+acquisition_mode = 'free'
+coherent_duration = 1  # seconds
+coherent_max_duration = desired_time_window  # seconds
+
+# Records are read in windows of transfer_chunk_size samples into the memory-mapped files
+# capture_<channel>_<amplitude>_<frequency>.npy of the run directory (see transfer.py),
+# one per point so no file is reopened while still mapped; None reads each record with
+# one curve?
+transfer_chunk_size = None
+
+# The arctangent is decimated to the drive frequency and this many harmonics before the
+# FFT and peak detection (None analyses at the full sampling rate). Triggered captures
+# stay at full rate to keep their exact number of samples per cycle
+decimation_harmonics = 5
+
+# Low-memory mode: the waves are scaled to float32 (complex64 spectra), combined in place
+# and released as soon as they are used, and no time vectors or plots are kept.
+# track_memory prints the peak memory of every analysis stage of each point
+low_memory = False
+track_memory = False
+memory = MemoryTracker(enabled=track_memory)
+
 # Define the multiplication factor for the arctangent
 factor = 100000 / 90  # pm/degree
 
@@ -81,36 +116,40 @@ scope.write('wfmoutpre:byt_n 1')
 scope.write('acquire:state 0')
 scope.write('acquire:stopafter SEQUENCE')
 
+if acquisition_mode == 'triggered':
+    configure_sync_output(funcgen)
+    configure_external_trigger(scope)
+    scope.query('*opc?')
+
 # Function to acquire waveform data
-def acquire_waveform(scope, channel, settings):
+def acquire_waveform(scope, channel, record_length, transfer_file=None):
     scope.write(f'data:source {channel}')
     time.sleep(0.1)  # Short delay
     current_source = scope.query('DATA:SOURCE?').strip()
     print(f"Current data source set to: {current_source}")
 
-    record_length = int(settings['sampling_rate'] * desired_time_window)
     scope.write(f'data:stop {record_length}')
 
-    bin_wave = scope.query_binary_values('curve?', datatype='b', container=np.array)
+    if transfer_chunk_size is None:
+        bin_wave = scope.query_binary_values('curve?', datatype='b', container=np.array)
+    else:
+        bin_wave = transfer_waveform(scope, record_length, transfer_file or f'capture_{channel}.npy', transfer_chunk_size)
 
     # Retrieve scaling factors
-    tscale = float(scope.query('wfmoutpre:xincr?'))
-    tstart = float(scope.query('wfmoutpre:xzero?'))
-    vscale = float(scope.query('wfmoutpre:ymult?'))
-    voff = float(scope.query('wfmoutpre:yzero?'))
-    vpos = float(scope.query('wfmoutpre:yoff?'))
-
-   
+    scaling = query_scaling(scope)
 
     # Create scaled vectors for the time-domain plot
-    total_time = tscale * record_length
-    tstop = tstart + total_time
-    scaled_time = np.linspace(tstart, tstop, num=record_length, endpoint=False)
-    unscaled_wave = np.array(bin_wave, dtype='double')
-    scaled_wave = (unscaled_wave - vpos) * vscale + voff
+    scaled_time = None if low_memory else time_vector(scaling, 0, record_length)
+    scaled_wave = scale_codes(bin_wave, scaling, dtype=work_dtype(low_memory))
+
+    return scaled_time, scaled_wave, scaling['xincr'], bin_wave, scaling
 
-    return scaled_time, scaled_wave, tscale
 
+# Raw captures of the whole sweep are archived here for later re-analysis, and every
+# capture is registered in the run catalog under the run of this sweep
+archive = WaveformArchive('raw_captures.h5')
+catalog = RunCatalog()
+run_id = catalog.new_run('maincalibration_funcgen_scope')
 
 # Loop over amplitude range and perform measurements
 for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_increment, amplitude_increment):
@@ -124,20 +163,54 @@ for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_incremen
         print('Output of function generator is turned on')
         print(f"Starting acquisition for amplitude: {amplitude} V and frequency: {frequency} Hz...")
 
+        # Triggered captures span an integer number of drive cycles
+        capture_attrs = {'acquisition_mode': acquisition_mode}
+        if acquisition_mode == 'triggered':
+            try:
+                n_cycles, record_length = configure_coherent_record(scope, frequency, coherent_duration,
+                                                                    coherent_max_duration)
+            except ValueError as e:
+                print(f"Skipping {amplitude} V, {frequency} Hz: {e}")
+                funcgen.write(f'OUTPUT{channel_out}:STATE OFF')
+                time.sleep(1)
+                continue
+            capture_attrs['n_cycles'] = n_cycles
+            print(f"Coherent record: {n_cycles} cycles, {record_length} samples")
+
         # Start acquisition
         scope.write('acquire:state 1')
         scope.query('*opc?')
 
         waveforms = {}
+        raw_codes = {}
+        raw_scaling = {}
 
         # Transfer waveform data from the oscilloscope for each channel
-        for channel, settings in channel_settings.items():
-            scaled_time, scaled_wave, tscale = acquire_waveform(scope, channel, settings)
-            waveforms[channel] = {
-                'time': scaled_time,
-                'wave': scaled_wave,
-                'tscale': tscale
-            }
+        with memory.stage('transfer'):
+            for channel, settings in channel_settings.items():
+                transfer_file = os.path.join(catalog.run_directory(run_id),
+                                             f'capture_{channel}_{round(amplitude, 2)}_{round(frequency, 2)}.npy')
+                scaled_time, scaled_wave, tscale, bin_wave, scaling = acquire_waveform(scope, channel, record_length,
+                                                                                       transfer_file)
+                waveforms[channel] = {
+                    'time': scaled_time,
+                    'wave': scaled_wave,
+                    'tscale': tscale
+                }
+                raw_codes[channel] = bin_wave
+                raw_scaling[channel] = scaling
+
+        # Archive the raw codes before any processing
+        with memory.stage('archive'):
+            capture_name = f'data_{round(amplitude, 2)}_{round(frequency, 2)}_{run_id}'
+            archive.write_capture(capture_name, raw_codes, raw_scaling,
+                                  amplitude=amplitude, frequency=frequency, channel_out=channel_out,
+                                  scope_idn=scope_idn, funcgen_idn=funcgen_idn, run_id=run_id, **capture_attrs)
+            catalog.register('raw_captures.h5', run_id, 'scope', round(amplitude, 2), round(frequency, 2),
+                             sample_rate=1 / tscale, axis=','.join(raw_codes), kind='h5', capture=capture_name,
+                             checksum=array_checksum(*raw_codes.values()))
+            # Releases the memory maps of the chunked transfer before the next point
+            del raw_codes, bin_wave
 
         # Turn off the output
         funcgen.write(f'OUTPUT{channel_out}:STATE OFF')
@@ -146,53 +219,85 @@ for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_incremen
 
         # Calculate the arctangent using the sine signal from CH2 and the cosine signal from CH3
         if 'CH1' in waveforms and 'CH2' in waveforms and 'CH3' in waveforms and 'CH4' in waveforms:
-            sine_wave = waveforms['CH1']['wave'] - waveforms['CH2']['wave']
-            cosine_wave = waveforms['CH3']['wave'] - waveforms['CH4']['wave']
-
-            # Ensure both arrays are of the same length for calculation
-            min_length = min(len(sine_wave), len(cosine_wave))
-            sine_wave = sine_wave[:min_length]
-            cosine_wave = cosine_wave[:min_length]
-            time_vector = waveforms['CH2']['time'][:min_length]
-
-            arctangent_radians = np.arctan2(sine_wave, cosine_wave)
-            arctangent_degrees = np.degrees(arctangent_radians)
-            result = arctangent_degrees * factor
+            with memory.stage('demodulation'):
+                # The differences are formed in place in the CH1 and CH3 waves
+                sine_wave = waveforms['CH1']['wave']
+                sine_wave -= waveforms['CH2']['wave']
+                cosine_wave = waveforms['CH3']['wave']
+                cosine_wave -= waveforms['CH4']['wave']
+
+                # Ensure both arrays are of the same length for calculation
+                min_length = min(len(sine_wave), len(cosine_wave))
+                sine_wave = sine_wave[:min_length]
+                cosine_wave = cosine_wave[:min_length]
+                time_axis = None if low_memory else waveforms['CH2']['time'][:min_length]
+                waveforms.clear()
+
+                # The arctangent overwrites the sine difference
+                result = np.arctan2(sine_wave, cosine_wave, out=sine_wave)
+                del cosine_wave
+                np.degrees(result, out=result)
+                result *= factor
             print("Arctangent calculation completed and multiplied by factor.")
 
+            sample_interval = tscale
+            if decimation_harmonics is not None and acquisition_mode == 'free':
+                with memory.stage('decimation'):
+                    decimator = drive_decimator(1 / tscale, frequency, decimation_harmonics)
+                    result = decimator.update(result)
+                if time_axis is not None:
+                    time_axis = time_axis[0] - decimator.delay + np.arange(len(result)) / decimator.output_rate
+                sample_interval = 1 / decimator.output_rate
+                print(f"Decimated by {decimator.factor} to {decimator.output_rate} Hz")
+
             # Plot the arctangent result
-            plt.figure(figsize=(12, 6))
-            plt.plot(time_vector, result)
-            plt.title(f'Arctangent IDS for {amplitude}V and {frequency}Hz')
-            plt.xlabel('Time (seconds)')
-            plt.ylabel('Result (pm)')
-            plt.grid(True)
-            # plt.show()
-
-            # Perform FFT on the arctangent result
-            fft_result = np.fft.fft(result)
-            fft_freq = np.fft.fftfreq(len(result), d=tscale)
-            fft_magnitude = np.abs(fft_result) / len(result)  # normalization
-
-            # Detect peaks in the FFT magnitude
-            peak_height_threshold = 0.01 * np.max(fft_magnitude)  # Dynamic threshold based on max magnitude
-            peak_distance_threshold = 100000  # Minimum number of samples between peaks
-            peak_prominence_threshold = 1000  # Adjust this value based on your data
-
-            peaks, properties = find_peaks(
-                fft_magnitude[:len(result) // 2],
-                height=peak_height_threshold,
-                distance=peak_distance_threshold,
-                prominence=peak_prominence_threshold
-                   # Plot the FFT of the arctangent result
-            )
-            plt.figure(figsize=(12, 6))
-            plt.plot(fft_freq[:len(result) // 2], fft_magnitude[:len(result) // 2])
-            plt.title(f'FFT IDS for {amplitude}V and {frequency}Hz')
-            plt.xlabel('Frequency (Hz)')
-            plt.ylabel('Magnitude')
-            plt.grid(True)
-            # plt.show()
+            if not low_memory:
+                plt.figure(figsize=(12, 6))
+                plt.plot(time_axis, result)
+                plt.title(f'Arctangent IDS for {amplitude}V and {frequency}Hz')
+                plt.xlabel('Time (seconds)')
+                plt.ylabel('Result (pm)')
+                plt.grid(True)
+                # plt.show()
+
+            with memory.stage('spectrum'):
+                # Perform FFT on the arctangent result
+                # One-sided spectrum; plan and output buffer are reused for every point
+                fft_freq, fft_magnitude = fftbackend.magnitude_spectrum(result, sample_interval)  # normalization
+
+                if acquisition_mode == 'triggered':
+                    # Coherent capture: the drive and its harmonics sit on exact bins
+                    table = harmonics.analyse_harmonics(result, 1 / tscale, frequency, window='rect', amplitudes=amplitude)
+                    with open('output_harmonics.txt', 'a') as file:
+                        harmonics.write_table(table, file)
+                    peaks = []
+                else:
+                    # Detect peaks in the FFT magnitude. The distance is given in frequency
+                    # bins derived from the drive, so it holds for any record length and
+                    # decimation: just under the spacing of the harmonics. The search starts
+                    # at half the drive frequency, so drift below it is not taken as first peak
+                    bin_width = fft_freq[1]
+                    first_bin = int(0.5 * frequency / bin_width)
+                    peak_height_threshold = 0.01 * np.max(fft_magnitude)  # Dynamic threshold based on max magnitude
+                    peak_distance_threshold = max(1, int(0.9 * frequency / bin_width))  # Minimum number of bins between peaks
+                    peak_prominence_threshold = 1000  # Adjust this value based on your data
+
+                    peaks, properties = find_peaks(
+                        fft_magnitude[first_bin:len(result) // 2],
+                        height=peak_height_threshold,
+                        distance=peak_distance_threshold,
+                        prominence=peak_prominence_threshold
+                           # Plot the FFT of the arctangent result
+                    )
+                    peaks += first_bin
+            if not low_memory:
+                plt.figure(figsize=(12, 6))
+                plt.plot(fft_freq[:len(result) // 2], fft_magnitude[:len(result) // 2])
+                plt.title(f'FFT IDS for {amplitude}V and {frequency}Hz')
+                plt.xlabel('Frequency (Hz)')
+                plt.ylabel('Magnitude')
+                plt.grid(True)
+                # plt.show()
 
             # Print detected peak frequencies and their magnitudes
             for peak in peaks:
@@ -200,7 +305,11 @@ for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_incremen
 
             # Open or create the results file in append mode
             with open('output_1peak.txt', 'a') as file:
-                if len(peaks) > 0:
+                if acquisition_mode == 'triggered':
+                    # Half the peak amplitude matches the |FFT| / N normalisation
+                    first_peak_magnitude = table['harmonics'][0, 0] / 2
+                    first_peak_frequency = table['fundamental_frequency'][0]
+                elif len(peaks) > 0:
                     # Get the magnitude and frequency of the first detected peak
                     first_peak_magnitude = fft_magnitude[peaks[0]]
                     first_peak_frequency = fft_freq[peaks[0]]
@@ -215,6 +324,12 @@ for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_incremen
                 file.write(f'{amplitude} V, {frequency} Hz, {first_peak_frequency} Hz, {first_peak_magnitude}\n')
 
             print("\nResults saved to output_1peak.txt")
+
+        if track_memory:
+            print(f"Peak memory of the point: {memory.peak() / 2 ** 20:.1f} MB")
+            print(memory.report())
+            memory.reset()
+archive.close()
+catalog.close()
 funcgen.close()
-scope.close()
-rm.close()
\ No newline at end of file
+scope.close()
\ No newline at end of file
@@ -0,0 +1,45 @@
+import contextlib
+import time
+import tracemalloc
+
+
+# Working precision of the analysis chain: float64 by default, float32 (and complex64
+# spectra) in low-memory mode, which halves every array from the scaling onwards
+def work_dtype(low_memory):
+    return 'float32' if low_memory else 'double'
+
+
+# Peak memory per analysis stage, measured with tracemalloc (numpy reports its array
+# buffers to it). Each stage records the highest traced memory while it ran and the
+# memory still held when it finished, so the stage that sets the peak of a point is
+# visible. Tracing slows down Python allocations, so it is off unless enabled
+class MemoryTracker:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            self.stages.append((name, peak, current, time.perf_counter() - t0))
+
+    def peak(self):
+        return max((peak for _, peak, _, _ in self.stages), default=0)
+
+    def reset(self):
+        self.stages = []
+
+    def report(self):
+        lines = [f'{name:<14} peak {peak / 2 ** 20:9.1f} MB  held {current / 2 ** 20:9.1f} MB  {seconds:7.3f} s'
+                 for name, peak, current, seconds in self.stages]
+        return '\n'.join(lines)
@@ -0,0 +1,73 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from catalog import sweep_files
+
+axis_columns = ['Pos0', 'Pos1', 'Pos2']
+
+
+# Read a converted .aws file and return the sample spacing and the three axes as a 3xN array
+def load_axes(file_path):
+    data = pd.read_csv(file_path, header=None, names=['Time'] + axis_columns)
+    dt = data['Time'][1] - data['Time'][0]
+    axes = data[axis_columns].to_numpy(dtype='double').T
+    # Remove the absolute position of each axis
+    axes -= axes.mean(axis=1, keepdims=True)
+    return dt, axes
+
+
+# Complex amplitude of every axis at the drive frequency and its harmonics.
+# Projects the Hann-windowed traces onto exp(-2 pi i k f0 t), which gives the same
+# value as the FFT bin when k*f0 falls on a bin and does not need the full spectrum.
+# Returns an array of shape (3, n_harmonics); abs() is the amplitude in pm
+def harmonic_amplitudes(axes, dt, drive_frequency, n_harmonics=5):
+    n = axes.shape[1]
+    t = np.arange(n) * dt
+    window = np.hanning(n)
+    harmonics = drive_frequency * np.arange(1, n_harmonics + 1)
+    reference = np.exp(-2j * np.pi * np.outer(harmonics, t))
+    return 2 * (axes * window) @ reference.T / window.sum()
+
+
+# Cross-axis coupling at the drive frequency: entry [i, j] is the response of axis j
+# relative to axis i (complex, so it carries the relative phase too). The row of the
+# driven axis is the cross-axis sensitivity of the device under test
+def coupling_matrix(fundamental):
+    return fundamental[np.newaxis, :] / fundamental[:, np.newaxis]
+
+
+def main(run_id=None):
+    n_harmonics = 5
+
+    for rounded_amplitude, rounded_frequency, file_path in sweep_files('csv', run_id):
+        if not os.path.isfile(file_path):
+            print(f"File not found: {file_path}")
+            continue
+
+        dt, axes = load_axes(file_path)
+        amplitudes = harmonic_amplitudes(axes, dt, rounded_frequency, n_harmonics)
+        coupling = coupling_matrix(amplitudes[:, 0])
+
+        # The driven axis is the one with the largest response at the drive frequency
+        driven_axis = int(np.argmax(np.abs(amplitudes[:, 0])))
+        cross_axis = np.abs(coupling[driven_axis])
+
+        for axis in range(3):
+            harmonics = ', '.join(f'{a:.6g}' for a in np.abs(amplitudes[axis]))
+            print(f"{rounded_amplitude} V, {rounded_frequency} Hz, axis {axis}: {harmonics}")
+        print(f"Driven axis: {driven_axis}, cross-axis coupling: {cross_axis}")
+
+        # One line per axis: harmonic amplitudes (pm) followed by the coupling row
+        with open('output_ids_3axis.txt', 'a') as file:
+            for axis in range(3):
+                harmonics = ', '.join(f'{a}' for a in np.abs(amplitudes[axis]))
+                row = ', '.join(f'{c}' for c in np.abs(coupling[axis]))
+                file.write(f'{rounded_amplitude} V, {rounded_frequency} Hz, {axis}, {harmonics}, {row}\n')
+        print("\nResults saved to output_ids_3axis.txt")
+
+    print("\nEnd")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,358 @@
+import asyncio
+import collections
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import sounddevice as sd
+import soundfile as sf
+from instrument_server import open_instrument, open_ids
+from live_monitor import RollingMonitor, terminal_view, ids_tap
+from catalog import RunCatalog, file_checksum
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+# Build the list of (amplitude, frequency) points of a sweep, rounded like the file names
+def sweep_points(initial_amplitude, max_amplitude, amplitude_increment,
+                 initial_frequency, max_frequency, frequency_increment):
+    points = []
+    for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_increment, amplitude_increment):
+        for frequency in np.arange(initial_frequency, max_frequency + frequency_increment, frequency_increment):
+            points.append((round(float(amplitude), 2), round(float(frequency), 2)))
+    return points
+
+
+# A sweep point (amplitude, frequency) together with the number of its measurement attempt
+# and whether a live monitor rejected it. It unpacks like the plain point
+class Attempt(tuple):
+    def __new__(cls, point, number=1):
+        attempt = super().__new__(cls, point)
+        attempt.number = number
+        attempt.rejected = False
+        return attempt
+
+
+# Data file of a point; repeated attempts get their own files, so a rejected capture is
+# kept next to its re-measurement
+def point_file(data_dir, point, extension):
+    amplitude, frequency = point
+    retry = getattr(point, 'number', 1) - 1
+    suffix = f'_retry{retry}' if retry else ''
+    return os.path.join(data_dir, f"data_{amplitude}_{frequency}{suffix}.{extension}")
+
+
+# Base class: every instrument owns a single worker thread, so its blocking driver
+# calls run in order, never interleave with another instrument and never block the loop
+class Instrument:
+    name = 'instrument'
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+        # Run catalog the written files are registered in (see catalog.py)
+        self.catalog = None
+        self.run_id = None
+
+    async def call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    # Register a written file in the catalog. The file is hashed in a separate thread, so
+    # neither the loop nor this instrument's thread waits for it. Rejected captures are
+    # registered as kind 'rejected', which the analysis does not select
+    async def register(self, file_path, point, **kwargs):
+        if self.catalog is None:
+            return
+        checksum = await asyncio.to_thread(file_checksum, file_path)
+        kind = 'rejected' if getattr(point, 'rejected', False) else None
+        self.catalog.register(file_path, self.run_id, self.name, *point, kind=kind, checksum=checksum, **kwargs)
+
+    # Phases of one sweep point, all optional
+    async def configure(self, point):
+        pass
+
+    async def arm(self, point):
+        pass
+
+    async def start(self, point):
+        pass
+
+    async def stop(self, point):
+        pass
+
+    async def teardown(self, point):
+        pass
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class FunctionGenerator(Instrument):
+    name = 'funcgen'
+
+    def __init__(self, ip, channel_out=1, settle_time=2):
+        super().__init__()
+        self.channel_out = channel_out
+        self.settle_time = settle_time
+        self.funcgen = open_instrument(f'TCPIP0::{ip}::INSTR')
+        self.funcgen.write_termination = '\n'
+        self.funcgen.read_termination = '\n'
+        self.funcgen.write('*CLS')
+
+    def _configure(self, amplitude, frequency):
+        self.funcgen.write(f'SOURCE{self.channel_out}:FUNCTION SIN')
+        self.funcgen.write(f'SOURCE{self.channel_out}:VOLTAGE:AMPLITUDE {amplitude}')
+        self.funcgen.write(f'SOURCE{self.channel_out}:FREQUENCY {frequency}')
+        self.funcgen.write(f'OUTPUT{self.channel_out}:STATE ON')
+        # Let the shaker reach steady state before the capture is armed
+        time.sleep(self.settle_time)
+        print(f'Output of function generator is turned on ({amplitude} V, {frequency} Hz)')
+
+    def _output_off(self):
+        self.funcgen.write(f'OUTPUT{self.channel_out}:STATE OFF')
+        time.sleep(self.settle_time)
+        print('Output of function generator is turned off')
+
+    async def configure(self, point):
+        await self.call(self._configure, *point)
+
+    async def teardown(self, point):
+        await self.call(self._output_off)
+
+    def close(self):
+        super().close()
+        self.funcgen.close()
+
+
+class IDSStream(Instrument):
+    name = 'ids'
+
+    def __init__(self, ip, stream_frequency=10, data_dir=script_dir, monitor=None):
+        super().__init__()
+        # Optional RollingMonitor fed by polling the IDS during the capture
+        self.monitor = monitor
+        self.tap = None
+        self.stream_frequency = stream_frequency
+        self.data_dir = data_dir
+        # Stream all three axes in one session
+        self.axes = dict(axis0=True, axis1=True, axis2=True)
+        self.ids = open_ids(ip)
+        self.t_start = None
+        self.t_stop = None
+
+    def data_file(self, point):
+        return point_file(self.data_dir, point, 'aws')
+
+    async def arm(self, point):
+        # Polled at a few Hz, far below the drive frequency: track level and steps only
+        if self.monitor is not None:
+            self.monitor.reset(None)
+        stream = await self.call(self.ids.streaming.open, True, self.stream_frequency, self.data_file(point), **self.axes)
+        print(stream)
+
+    def _start(self, data_file):
+        self.ids.streaming.startBackgroundStreaming(True, self.stream_frequency, data_file, **self.axes)
+        self.t_start = time.perf_counter()
+        if self.monitor is not None:
+            self.tap = ids_tap(self.ids, self.monitor)
+
+    def _stop(self):
+        if self.tap is not None:
+            self.tap.set()
+            self.tap = None
+        self.ids.streaming.stopBackgroundStreaming()
+        self.t_stop = time.perf_counter()
+
+    async def start(self, point):
+        await self.call(self._start, self.data_file(point))
+
+    async def stop(self, point):
+        await self.call(self._stop)
+        print(f"Background streaming stopped, data saved to {self.data_file(point)}")
+
+    # Registered in the teardown, which overlaps the next point
+    async def teardown(self, point):
+        await self.register(self.data_file(point), point, axis=','.join(axis for axis, on in self.axes.items() if on))
+
+
+class AudioRecorder(Instrument):
+    name = 'audio'
+
+    def __init__(self, device_id=1, sample_rate=44100, channels=2, duration=10, data_dir=script_dir,
+                 monitor=None, monitor_channel=0):
+        super().__init__()
+        # Optional RollingMonitor fed from the capture callback
+        self.monitor = monitor
+        self.monitor_channel = monitor_channel
+        self.device_id = device_id
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.duration = duration
+        self.data_dir = data_dir
+        self.stream = None
+        self.t_start = None
+        self.t_stop = None
+
+    def data_file(self, point):
+        return point_file(self.data_dir, point, 'flac')
+
+    def _open(self, frequency):
+        if self.monitor is not None:
+            self.monitor.reset(frequency)
+
+        # Preallocate the whole capture and let the callback fill it, so start/stop
+        # are plain stream calls instead of a blocking sd.rec()/sd.wait() pair
+        self.audio = np.zeros((int(self.duration * self.sample_rate), self.channels), dtype='float32')
+        self.frames = 0
+
+        def callback(indata, frames, time_info, status):
+            n = min(frames, len(self.audio) - self.frames)
+            self.audio[self.frames:self.frames + n] = indata[:n]
+            self.frames += n
+            if self.monitor is not None:
+                self.monitor.update(indata[:n, self.monitor_channel])
+            if self.frames >= len(self.audio):
+                raise sd.CallbackStop()
+
+        self.stream = sd.InputStream(device=self.device_id, samplerate=self.sample_rate,
+                                     channels=self.channels, dtype='float32', callback=callback)
+
+    def _start(self):
+        self.stream.start()
+        self.t_start = time.perf_counter()
+
+    def _stop(self):
+        # The callback ends the stream itself once the buffer is full, give it a
+        # moment to drain the last block before stopping it
+        deadline = time.perf_counter() + 0.5
+        while self.stream.active and time.perf_counter() < deadline:
+            time.sleep(0.005)
+        self.stream.stop()
+        self.t_stop = time.perf_counter()
+        self.stream.close()
+        self.stream = None
+
+    def _save(self, audio_file, audio):
+        sf.write(audio_file, audio, self.sample_rate)
+        print(f"File saved as {os.path.basename(audio_file)}")
+
+    async def arm(self, point):
+        await self.call(self._open, point[1])
+
+    async def start(self, point):
+        await self.call(self._start)
+
+    async def stop(self, point):
+        await self.call(self._stop)
+        if self.frames < len(self.audio):
+            print(f"Warning: audio capture ended early ({self.frames}/{len(self.audio)} frames)")
+
+    async def teardown(self, point):
+        await self.call(self._save, self.data_file(point), self.audio[:self.frames])
+        await self.register(self.data_file(point), point, sample_rate=self.sample_rate)
+
+
+# Run one phase on every instrument concurrently; returns once all have finished,
+# so each call acts as a barrier between phases
+async def barrier(instruments, phase, point):
+    await asyncio.gather(*(getattr(instrument, phase)(point) for instrument in instruments))
+
+
+# Sweep driver: arm all instruments in parallel, bracket the capture with start/stop
+# barriers and let the teardown of a point overlap the configuration of the next one.
+# Points flagged by one of the live monitors are measured again at the end of the sweep;
+# every attempt is written to its own files
+async def run_sweep(instruments, points, duration, monitors=None, max_retries=2):
+    pending = []
+    queue = collections.deque(points)
+    attempts = collections.Counter()
+    while queue:
+        plain_point = queue.popleft()
+        attempts[plain_point] += 1
+        point = Attempt(plain_point, attempts[plain_point])
+        amplitude, frequency = point
+        print(f"Starting acquisition for amplitude: {amplitude} V and frequency: {frequency} Hz...")
+
+        # Configuration and arming are queued behind the previous teardown on each
+        # instrument's own thread, so they only wait where they actually share hardware
+        await barrier(instruments, 'configure', point)
+        await barrier(instruments, 'arm', point)
+
+        await barrier(instruments, 'start', point)
+        view = terminal_view(monitors) if monitors else None
+        await asyncio.sleep(duration)
+        await barrier(instruments, 'stop', point)
+        if view is not None:
+            view.set()
+
+        starts = [i.t_start for i in instruments if getattr(i, 't_start', None) is not None]
+        if len(starts) > 1:
+            print(f"Start skew between instruments: {1e3 * (max(starts) - min(starts)):.1f} ms")
+
+        # The verdict is known before the teardown, which registers the files
+        faults = [f'{name}: {fault}' for name, monitor in (monitors or {}).items() for fault in monitor.faults()]
+        if faults:
+            point.rejected = True
+            print(f"Bad point {amplitude} V, {frequency} Hz: {'; '.join(faults)}")
+            if attempts[plain_point] <= max_retries:
+                print("Point re-queued")
+                queue.append(plain_point)
+
+        # Do not wait for the teardown here, the next point is configured meanwhile.
+        # The tasks are created before the next configure so they reach each
+        # instrument's thread first
+        pending = [task for task in pending if not task.done()]
+        pending.extend(asyncio.ensure_future(i.teardown(point)) for i in instruments)
+
+    await asyncio.gather(*pending)
+
+
+def main():
+    duration = 10  # seconds per point
+
+    # Every sweep is a new run in the catalog, with its own data directory
+    catalog = RunCatalog()
+    run_id = catalog.new_run('orchestrate')
+    data_dir = catalog.run_directory(run_id)
+
+    # Instruments are opened through the instrument server if it is running (see
+    # instrument_server.py), otherwise directly without scanning the network
+    funcgen = FunctionGenerator('192.168.1.4', channel_out=1)
+    # Live check of the IDS position, polled at 100 Hz: jumps larger than max_step (pm)
+    # between polls count as lost fringe
+    ids_monitor = RollingMonitor(100, window_time=1.0, max_step=1e8)
+    ids = IDSStream('192.168.1.1', data_dir=data_dir, monitor=ids_monitor)
+    # Live check of the accelerometer signal: saturation and missing drive
+    monitor = RollingMonitor(44100, window_time=1.0, clip_level=0.99, min_drive=1e-3)
+    audio = AudioRecorder(device_id=1, sample_rate=44100, duration=duration, data_dir=data_dir, monitor=monitor)
+    for instrument in (ids, audio):
+        instrument.catalog = catalog
+        instrument.run_id = run_id
+
+    print(f"Using device: {sd.query_devices(audio.device_id)['name']}")
+    try:
+        print("Warm-up recording...")
+        sd.rec(int(5 * audio.sample_rate), samplerate=audio.sample_rate, channels=2,
+               dtype='float32', device=audio.device_id)
+        sd.wait()
+        print("Warm-up finished.")
+    except Exception as e:
+        print(f"Warm-up recording failed: {e}")
+        return
+
+    # Define the parameters of the sweep
+    points = sweep_points(0.8, 1, 0.05, 20, 300, 20)
+
+    try:
+        asyncio.run(run_sweep([funcgen, ids, audio], points, duration, monitors={'ids': ids_monitor, 'audio': monitor}))
+    finally:
+        for instrument in (funcgen, ids, audio):
+            instrument.close()
+        catalog.close()
+
+    print("\nEnd")
+
+
+if __name__ == '__main__':
+    main()
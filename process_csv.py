@@ -2,42 +2,96 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-from scipy.signal import find_peaks
+import sys
+import fftbackend
+import harmonics
+from decimate import drive_decimator
+from catalog import sweep_files
+from memory import MemoryTracker, work_dtype
 import time
 
-def main():
-
-    # Define the initial parameters for the function generator
-    initial_amplitude = 0.05 # Initial amplitude in volts (pp is the same)
-    max_amplitude = 1  # Maximum amplitude in volts
-    amplitude_increment = 0.05  # Increment in volts
-    initial_frequency = 20  # Initial frequency in Hz
-    max_frequency = 300  # Maximum frequency in Hz
-    frequency_increment = 20  # Frequency increment in Hz
-
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-
-    for amplitude in np.arange(initial_amplitude, max_amplitude + amplitude_increment, amplitude_increment):
-        for frequency in np.arange(initial_frequency, max_frequency + frequency_increment, frequency_increment):
-            
-            # Round amplitude and frequency to two decimal places for file name
-            rounded_amplitude = round(amplitude, 2)
-            rounded_frequency = round(frequency, 2)
+# Low-memory mode: Pos0 is read in double precision chunk by chunk and only converted to
+# float32 relative to its first sample (the absolute positions are too large for float32),
+# without the Time and Displacement columns and without the plots. track_memory prints the
+# peak memory of every stage of each file
+low_memory = False
+track_memory = False
+chunk_size = 1000000  # rows per chunk in low-memory mode
+
+
+# Displacement of Pos0 as float32, centred on its mean. Returns (sample_interval, mean
+# position, trace); the mean is accumulated in double precision
+def load_displacement(file_path, dtype='float32'):
+    offset = None
+    total = 0.0
+    parts = []
+    for data in pd.read_csv(file_path, header=None, usecols=[0, 1], chunksize=chunk_size):
+        if offset is None:
+            sample_interval = data[0].iloc[1] - data[0].iloc[0]
+            offset = data[1].iloc[0]
+        position = data[1].to_numpy() - offset
+        total += position.sum()
+        parts.append(position.astype(dtype))
+    trace = np.concatenate(parts)
+    del parts
+    residual = total / len(trace)
+    trace -= trace.dtype.type(residual)
+    return sample_interval, offset + residual, trace
+
+# Harmonic table of a batch of (amplitude, frequency, trace, sample_rate) points, appended
+# to the peak ratio, first peak and full harmonic result files
+def write_results(points, n_harmonics):
+    amplitudes = [point[0] for point in points]
+    frequencies = [point[1] for point in points]
+    stack = np.stack([point[2] for point in points])
+    table = harmonics.analyse_harmonics(stack, points[0][3], frequencies, n_harmonics, amplitudes=amplitudes)
+
+    with open('output_ids_peakratio_1.txt', 'a') as file:
+        for row in table:
+            print(f"Writing results: {row['amplitude']:g} V, {row['frequency']:g} Hz, {row['fundamental_frequency']} Hz, "
+                  f"harmonics {row['harmonics']}, THD {row['thd']}, SINAD {row['sinad_db']} dB, {row['peak_ratio']}")
+            file.write(f"{row['amplitude']:g} V, {row['frequency']:g} Hz, {row['peak_ratio']}\n")
+    print("\nPeak ratio results saved to output_ids_peakratio_1.txt")
+
+    # Half the peak amplitude keeps the |FFT| / N normalisation of the earlier results
+    with open('output_ids_firstpeak_1.txt', 'a') as file:
+        for row in table:
+            file.write(f"{row['amplitude']:g} V, {row['frequency']:g} Hz, {row['harmonics'][0] / 2}\n")
+    print("\nFirst peak magnitude results saved to output_ids_firstpeak_1.txt")
+
+    with open('output_ids_harmonics.txt', 'a') as file:
+        harmonics.write_table(table, file)
+    print("\nHarmonic tables saved to output_ids_harmonics.txt")
+
+
+def main(run_id=None):
+    n_harmonics = 5  # Fundamental and harmonics evaluated per trace
+    batch_size = 32  # Traces analysed together
+
+    files = sweep_files('csv', run_id)
+    max_frequency = max((frequency for _, frequency, _ in files), default=0)
+
+    memory = MemoryTracker(enabled=track_memory)
+    pending = []
+    decimator = None
+    for rounded_amplitude, rounded_frequency, file_path in files:
+        if not os.path.isfile(file_path):
+            print(f"File not found: {file_path}")
+            continue
             
-            #file_path = f'data_{amplitude}_{frequency}.csv'
-            file_name = f'data_{rounded_amplitude}_{rounded_frequency}.csv'
-            file_path = os.path.join(script_dir, file_name)
-            
-            if not os.path.isfile(file_path):
-                print(f"File not found: {file_path}")
-                continue
-            
-            # Read the file
-            data = pd.read_csv(file_path, header=None, names=['Time', 'Pos0', 'Unused1', 'Unused2'], usecols=['Time', 'Pos0'])
-
-            # Calculate the mean of the 'Pos0' column
-            mean_position = data['Pos0'].mean()
-            print(f"The mean of the absolute positions ({rounded_amplitude}V_{rounded_frequency}Hz) is: {mean_position}")
+        # Read the file
+        with memory.stage('load'):
+            if low_memory:
+                sample_interval, mean_position, trace = load_displacement(file_path, work_dtype(low_memory))
+            else:
+                data = pd.read_csv(file_path, header=None, names=['Time', 'Pos0', 'Pos1', 'Pos2'], usecols=['Time', 'Pos0'])
+                sample_interval = data['Time'][1] - data['Time'][0]
+
+                # Calculate the mean of the 'Pos0' column
+                mean_position = data['Pos0'].mean()
+        print(f"The mean of the absolute positions ({rounded_amplitude}V_{rounded_frequency}Hz) is: {mean_position}")
+
+        if not low_memory:
             # Plot
             trace = data['Displacement'] = data['Pos0'] - mean_position
             tscale = data['Time']
@@ -51,73 +105,53 @@ def main():
             #plt.show()
 
             # Perform FFT
-            fft_result = np.fft.fft(data['Displacement'])
-            fft_result[:100] = 0
-            fft_freq = np.fft.fftfreq(len(fft_result), d=(data['Time'][1] - data['Time'][0]))
-            fft_magnitude = np.abs(fft_result) / len(trace)
-
-            peak_height_threshold = 0.01 * np.max(fft_magnitude)  # Dynamic threshold based on max magnitude
-            peak_distance_threshold = 50  # Minimum number of samples between peaks
-            peak_prominence_threshold = 10  # Adjust this value based on your data
-
-            peaks, properties = find_peaks(
-                fft_magnitude[:len(trace) // 2],
-                height=peak_height_threshold,
-                distance=peak_distance_threshold,
-                prominence=peak_prominence_threshold
-            )
+            with memory.stage('fft'):
+                fft_result = fftbackend.rfft(data['Displacement'].to_numpy(), reuse=True)
+                fft_result[:100] = 0
+                fft_freq = fftbackend.rfftfreq(len(trace), d=sample_interval)
 
             # Plot FFT
             plt.figure(figsize=(10, 6))
-            plt.plot(fft_freq[:len(fft_freq)//2], np.abs(fft_result)[:len(fft_freq)//2])
+            plt.plot(fft_freq[:len(trace)//2], np.abs(fft_result)[:len(trace)//2])
             plt.xlabel('Frequency (Hz)')
             plt.ylabel('Amplitude')
             plt.title('FFT of Displacement')
             plt.xlim(0, 1000)
             plt.grid(True)
             #plt.show()
-
-            for peak in peaks:
-                print(f"Peak detected at frequency: {fft_freq[peak]} Hz with magnitude: {fft_magnitude[peak]}")
-
-            # Open or create the second results file in append mode
-            with open('output_ids_peakratio_1.txt', 'a') as file:
-                if len(peaks) > 0:
-                    # Get the magnitudes and frequencies of the first and second detected peaks
-                    first_peak_magnitude = fft_magnitude[peaks[0]]
-                    first_peak_frequency = fft_freq[peaks[0]]
-                    if len(peaks) > 1:
-                        second_peak_magnitude = fft_magnitude[peaks[1]]
-                        second_peak_frequency = fft_freq[peaks[1]]
-                    else:
-                        second_peak_magnitude = None
-                        second_peak_frequency = None
-                else:
-                    # If no peaks are detected, set values to None or some default
-                    first_peak_magnitude = None
-                    first_peak_frequency = None
-                    second_peak_magnitude = None
-                    second_peak_frequency = None
-
-                # Calculate the ratio of the first peak magnitude to the second peak magnitude
-                if first_peak_magnitude is not None and second_peak_magnitude is not None:
-                    peak_ratio = first_peak_magnitude / second_peak_magnitude
-                else:
-                    peak_ratio = 0
-
-                print(f"Writing results: {rounded_amplitude} V, {rounded_frequency} Hz, {first_peak_frequency} Hz, {first_peak_magnitude}, {second_peak_frequency} Hz, {second_peak_magnitude}, {peak_ratio}")
-
-                # Write the results to the file
-                #file.write(f'{amplitude} V, {frequency} Hz, {first_peak_frequency} Hz, {first_peak_magnitude}, {second_peak_frequency} Hz, {second_peak_magnitude}, {peak_ratio}\n')
-                
-                file.write(f'{rounded_amplitude} V, {rounded_frequency} Hz, {peak_ratio}\n')
-                print("\nPeak ratio results saved to output_ids_peakratio_1.txt")
-            with open('output_ids_firstpeak_1.txt', 'a') as file:
-                file.write(f'{rounded_amplitude} V, {rounded_frequency} Hz, {first_peak_magnitude}\n')
-                print("\nFirst peak magnitude results saved to output_ids_firstpeak_1.txt")
+            trace = data['Displacement'].to_numpy()
+            del data
+
+        # Anti-alias decimation to the band of the highest drive frequency of the sweep,
+        # so all points share one output rate and can be analysed together
+        sample_rate = 1 / sample_interval
+        with memory.stage('decimation'):
+            if decimator is None or decimator.sample_rate != sample_rate:
+                decimator = drive_decimator(sample_rate, max_frequency, n_harmonics)
+            decimator.reset()
+            displacement = decimator.update(trace)
+            del trace
+
+        # Harmonic analysis runs on batches of equal-length traces
+        if pending and (len(displacement) != len(pending[0][2]) or decimator.output_rate != pending[0][3]
+                        or len(pending) == batch_size):
+            with memory.stage('harmonics'):
+                write_results(pending, n_harmonics)
+            pending = []
+        pending.append((rounded_amplitude, rounded_frequency, displacement, decimator.output_rate))
+
+        if track_memory:
+            print(memory.report())
+            memory.reset()
+
+    if pending:
+        with memory.stage('harmonics'):
+            write_results(pending, n_harmonics)
+        if track_memory:
+            print(memory.report())
 
     print("\nEnd")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(*sys.argv[1:])
\ No newline at end of file
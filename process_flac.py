@@ -0,0 +1,108 @@
+import os
+import sys
+import numpy as np
+import soundfile as sf
+from scipy.signal import butter, sosfilt, sosfilt_zi
+from decimate import Decimator, drive_bandwidth
+from catalog import sweep_files
+
+
+# One-pass analysis of an accelerometer recording of known length, fed block by block.
+# Band-pass filtering carries the filter state between blocks, the filtered signal is
+# scaled to acceleration and only running sums are kept (sum of squares for the RMS and
+# one complex sum per harmonic), so memory does not depend on the file length.
+# With decimation=True the blocks are first decimated to the analysis band (the upper
+# band edge and the harmonics), so everything after it runs on far fewer samples.
+class StreamingAnalysis:
+    def __init__(self, sample_rate, n_frames, drive_frequency, n_harmonics=5,
+                 band=(5, 2000), scale=1.0, settle_time=0.5, decimation=True):
+        self.decimator = None
+        if decimation:
+            self.decimator = Decimator(sample_rate, max(band[1], drive_bandwidth(drive_frequency, n_harmonics)))
+            sample_rate = self.decimator.output_rate
+            n_frames = -(-n_frames // self.decimator.factor)
+        self.sample_rate = sample_rate
+        self.n_frames = n_frames
+        self.harmonics = drive_frequency * np.arange(1, n_harmonics + 1)
+        self.scale = scale  # m/s^2 per unit of the recorded signal
+        self.sos = butter(4, band, btype='bandpass', fs=sample_rate, output='sos')
+        self.zi = None
+        # Samples at the start that are dropped while the filter settles
+        self.skip = min(int(settle_time * sample_rate), n_frames // 2)
+        self.n_seen = 0
+        self.n_used = 0
+        self.sum_squares = 0.0
+        self.sum_harmonics = np.zeros(n_harmonics, dtype=complex)
+        self.sum_window = 0.0
+
+    def update(self, block):
+        block = np.asarray(block, dtype='double')
+        if self.decimator is not None:
+            block = self.decimator.update(block)
+            if len(block) == 0:
+                return self
+        if self.zi is None:
+            self.zi = sosfilt_zi(self.sos) * block[0]
+        filtered, self.zi = sosfilt(self.sos, block, zi=self.zi)
+        index = self.n_seen + np.arange(len(block))
+        self.n_seen += len(block)
+
+        used = index >= self.skip
+        acceleration = filtered[used] * self.scale
+        index = index[used]
+        if len(index) == 0:
+            return self
+
+        self.sum_squares += np.dot(acceleration, acceleration)
+        self.n_used += len(acceleration)
+
+        # Hann window over the analysed part of the file, known in advance from its length
+        length = self.n_frames - self.skip
+        window = 0.5 - 0.5 * np.cos(2 * np.pi * (index - self.skip) / length)
+        cycles = np.mod(np.outer(self.harmonics, index), self.sample_rate) / self.sample_rate
+        self.sum_harmonics += np.exp(-2j * np.pi * cycles) @ (acceleration * window)
+        self.sum_window += window.sum()
+        return self
+
+    def rms(self):
+        return np.sqrt(self.sum_squares / self.n_used)
+
+    # Amplitude (m/s^2) of the drive frequency and its harmonics
+    def harmonic_amplitudes(self):
+        return 2 * np.abs(self.sum_harmonics) / self.sum_window
+
+
+# Stream one FLAC file through the analysis
+def analyse_flac(file_path, drive_frequency, channel=0, blocksize=65536, **kwargs):
+    info = sf.info(file_path)
+    analysis = StreamingAnalysis(info.samplerate, info.frames, drive_frequency, **kwargs)
+    for block in sf.blocks(file_path, blocksize=blocksize, always_2d=True):
+        analysis.update(block[:, channel])
+    return analysis
+
+
+def main(run_id=None):
+    n_harmonics = 5
+    channel = 0  # audio channel of the accelerometer
+    scale = 1.0  # m/s^2 per unit of the recorded signal (accelerometer calibration)
+
+    for rounded_amplitude, rounded_frequency, file_path in sweep_files('flac', run_id):
+        if not os.path.isfile(file_path):
+            print(f"File not found: {file_path}")
+            continue
+
+        analysis = analyse_flac(file_path, rounded_frequency, channel=channel, n_harmonics=n_harmonics, scale=scale)
+        rms = analysis.rms()
+        amplitudes = analysis.harmonic_amplitudes()
+        print(f"{rounded_amplitude} V, {rounded_frequency} Hz: RMS acceleration {rms} m/s^2, harmonics {amplitudes}")
+
+        with open('output_acc.txt', 'a') as file:
+            harmonics = ', '.join(f'{a}' for a in amplitudes)
+            file.write(f'{rounded_amplitude} V, {rounded_frequency} Hz, {rms}, {harmonics}\n')
+        print("\nRMS and harmonic amplitudes saved to output_acc.txt")
+
+    print("\nEnd")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
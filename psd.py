@@ -0,0 +1,140 @@
+import os
+import sys
+import numpy as np
+from scipy.signal import get_window
+import fftbackend
+
+
+# Welch / median averaged power spectral density accumulated over consecutive chunks.
+# Incoming samples are cut into overlapping segments, every batch of complete segments
+# goes through one 2-D rfft and is added to a running sum, so the cost is linear in the
+# number of samples and memory only holds one chunk plus the unfinished segment.
+# The median estimate needs every segment spectrum and keeps them (n_segments x n_freq,
+# stored as float32), so its memory grows with the record: 4 * (nperseg / 2 + 1) bytes per
+# segment, e.g. 1.4 GB for one hour at 1e5 Sa/s with nperseg = 2**16 and 50 % overlap.
+# Use average='mean' or longer segments for long records.
+class WelchPSD:
+    def __init__(self, sample_rate, nperseg=2 ** 16, noverlap=None, window='hann', average='mean', detrend=True):
+        if average not in ('mean', 'median'):
+            raise ValueError(f"average must be 'mean' or 'median', not {average!r}")
+        if noverlap is None:
+            noverlap = nperseg // 2
+        if not 0 <= noverlap < nperseg:
+            raise ValueError('noverlap must be smaller than nperseg')
+        self.sample_rate = sample_rate
+        self.nperseg = nperseg
+        self.step = nperseg - noverlap
+        self.average = average
+        self.detrend = detrend
+        self.window = get_window(window, nperseg)
+        # One-sided density scaling as in scipy.signal.welch
+        self.scale = 1 / (sample_rate * np.sum(self.window ** 2))
+        self.frequencies = fftbackend.rfftfreq(nperseg, 1 / sample_rate)
+        self.n_segments = 0
+        self._sum = np.zeros(len(self.frequencies))
+        self._segments = []
+        self._pending = np.zeros(0)
+
+    def update(self, chunk):
+        data = np.concatenate((self._pending, np.asarray(chunk, dtype='double')))
+        n_complete = 0 if len(data) < self.nperseg else (len(data) - self.nperseg) // self.step + 1
+        if n_complete:
+            frames = np.lib.stride_tricks.sliding_window_view(data, self.nperseg)[::self.step][:n_complete]
+            if self.detrend:
+                frames = frames - frames.mean(axis=1, keepdims=True)
+            spectra = fftbackend.rfft(frames * self.window, axis=1)
+            power = (spectra.real ** 2 + spectra.imag ** 2) * self.scale
+            # Fold the negative frequencies into the one-sided spectrum
+            power[:, 1:-1 if self.nperseg % 2 == 0 else None] *= 2
+            if self.average == 'median':
+                self._segments.append(power.astype(np.float32))
+            else:
+                self._sum += power.sum(axis=0)
+            self.n_segments += n_complete
+        # Keep the samples still needed by the next segment
+        self._pending = data[n_complete * self.step:].copy()
+        return self
+
+    # Return the frequency axis and the averaged PSD of everything seen so far
+    def result(self):
+        if self.n_segments == 0:
+            raise ValueError(f'need at least {self.nperseg} samples for one segment')
+        if self.average == 'median':
+            segments = np.concatenate(self._segments, axis=0)
+            self._segments = [segments]
+            # Bias correction of the median of chi-squared (2 dof) values, as in scipy.signal.welch
+            ii = 2 * np.arange(1, (segments.shape[0] - 1) // 2 + 1)
+            bias = 1 + np.sum(1 / (ii + 1) - 1 / ii)
+            return self.frequencies, np.median(segments, axis=0).astype('double') / bias
+        return self.frequencies, self._sum / self.n_segments
+
+
+# Chunk sources for the data types of the setup
+def csv_chunks(file_path, column='Pos0', chunk_size=1000000):
+    import pandas as pd
+    reader = pd.read_csv(file_path, header=None, names=['Time', 'Pos0', 'Pos1', 'Pos2'],
+                         usecols=['Time', column], chunksize=chunk_size)
+    # The sample rate is taken from the first chunk, later chunks may have a single row
+    sample_rate = None
+    for data in reader:
+        if sample_rate is None:
+            sample_rate = 1 / (data['Time'].iloc[1] - data['Time'].iloc[0])
+        yield sample_rate, data[column].to_numpy()
+
+
+def flac_chunks(file_path, channel=0, chunk_size=1000000):
+    import soundfile as sf
+    sample_rate = sf.info(file_path).samplerate
+    for block in sf.blocks(file_path, blocksize=chunk_size, always_2d=True):
+        yield sample_rate, block[:, channel]
+
+
+def array_chunks(signal, sample_rate, chunk_size=1000000):
+    for i in range(0, len(signal), chunk_size):
+        yield sample_rate, signal[i:i + chunk_size]
+
+
+# Feed a chunk source into a WelchPSD created from the sample rate of the first chunk
+def welch_psd(chunks, **kwargs):
+    psd = None
+    for sample_rate, chunk in chunks:
+        if psd is None:
+            psd = WelchPSD(sample_rate, **kwargs)
+        psd.update(chunk)
+    if psd is None:
+        raise ValueError('no data')
+    return psd.result()
+
+
+def main(paths):
+    import matplotlib.pyplot as plt
+
+    nperseg = 2 ** 16  # samples per segment
+    noverlap = nperseg // 2
+    average = 'median'  # 'mean' for Welch, 'median' is robust against glitches
+
+    for file_path in paths:
+        if file_path.endswith('.flac'):
+            chunks = flac_chunks(file_path)
+        else:
+            chunks = csv_chunks(file_path)
+        frequencies, power = welch_psd(chunks, nperseg=nperseg, noverlap=noverlap, average=average)
+
+        # Noise floor as the median density in the band above the first bins
+        band = frequencies > 10 * frequencies[1]
+        print(f"{file_path}: noise floor {np.sqrt(np.median(power[band]))} /sqrt(Hz)")
+
+        base_name = os.path.splitext(file_path)[0]
+        np.savetxt(f'{base_name}_psd.txt', np.column_stack((frequencies, power)), header='frequency psd')
+
+        plt.figure(figsize=(10, 6))
+        plt.loglog(frequencies[1:], np.sqrt(power[1:]))
+        plt.xlabel('Frequency (Hz)')
+        plt.ylabel('Amplitude spectral density (1/sqrt(Hz))')
+        plt.title(f'{average.capitalize()} averaged spectrum of {os.path.basename(file_path)}')
+        plt.grid(True)
+    plt.show()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
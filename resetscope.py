@@ -1,17 +1,14 @@
-import pyvisa
+from instrument_server import open_instrument
 
 
-# Initialize VISA resource manager and list available instruments
-rm = pyvisa.ResourceManager()
-instruments = rm.list_resources()
-print(f"Connected instruments: {instruments}")
+# Instruments are opened through the instrument server if it is running (see
+# instrument_server.py), otherwise directly without scanning the network
 
 
 # Open the connection to the oscilloscope
 oscilloscope_ip = '192.168.1.10'
 scope_name = f'TCPIP0::{oscilloscope_ip}::INSTR'
-scope = rm.open_resource(scope_name)
+scope = open_instrument(scope_name)
 scope.write('FACtory') 
 
-scope.close()
-rm.close()
\ No newline at end of file
+scope.close()
\ No newline at end of file
@@ -2,21 +2,27 @@ import pyvisa
 import numpy as np
 import time
 import matplotlib.pyplot as plt
+from instrument_server import open_instrument, InstrumentServerError
+from psd import WelchPSD, welch_psd, array_chunks
+import fftbackend
+from archive import WaveformArchive, scaling_keys, scale_codes, time_vector
+from transfer import ChunkedTransfer
+from coherent import configure_external_trigger, configure_coherent_record
+from memory import MemoryTracker, work_dtype
 
-# Initialize the resource manager and connect to the oscilloscope
-rm = pyvisa.ResourceManager()
-instruments = rm.list_resources()
-print(f"Connected instruments: {instruments}")
+# Instruments are opened through the instrument server if it is running (see
+# instrument_server.py), otherwise directly without scanning the network
 
 oscilloscope_ip = '192.168.1.10'
 scope_name = f'TCPIP0::{oscilloscope_ip}::INSTR'
-scope = rm.open_resource(scope_name)
+scope = open_instrument(scope_name)
 scope.timeout = 100000  # Increase timeout to 20 seconds
 scope.read_termination = '\n'
 scope.write_termination = None
 scope.write('*cls')
 channel = 'CH1'
-print(scope.query('*idn?'))
+scope_idn = scope.query('*idn?')
+print(scope_idn)
 
 # Reset the oscilloscope and configure horizontal settings
 scope.write('*rst')
@@ -32,6 +38,18 @@ sampling_rate = 1e5  # 1000 Sa/s
 scope.write(f'Horizontal:MODE:SAMPLERATE {sampling_rate}')
 record_length = int(sampling_rate * desired_time_window)
 scope.write(f'HORIZONTAL:RECORDLENGTH {record_length}')
+
+# Triggered capture: trigger on the function generator's sync output (AUX input) and
+# record an integer number of cycles of drive_frequency instead of a free-running window
+triggered = False
+drive_frequency = 100  # Hz
+coherent_duration = 1  # minimum capture length in seconds
+coherent_max_duration = 10  # longest coherent capture in seconds
+if triggered:
+    configure_external_trigger(scope)
+    n_cycles, record_length = configure_coherent_record(scope, drive_frequency, coherent_duration,
+                                                        coherent_max_duration)
+    print(f"Coherent record: {n_cycles} cycles, {record_length} samples")
 print(scope.query('HORIZONTAL?'))
 
 # Turn on Channel
@@ -68,6 +86,21 @@ scope.write('data:start 1')
 scope.write(f'data:stop {record_length}')
 scope.write('wfmoutpre:byt_n 1')
 
+# Chunked transfer: read the record in windows of transfer_chunk_size samples into a
+# memory-mapped file (see transfer.py); None reads the whole record with one curve?
+transfer_chunk_size = None
+transfer_file = f'scope_capture_{time.strftime("%Y%m%d_%H%M%S")}.npy'
+
+# Spectrum mode: 'fft' for a single periodogram, 'psd' for a median averaged PSD
+spectrum_mode = 'fft'
+psd_segment_length = 2 ** 16  # samples per segment in 'psd' mode
+
+# Low-memory mode: only the cropped record is scaled, to float32 in place (complex64
+# spectrum). track_memory prints the peak memory of every stage
+low_memory = False
+track_memory = False
+memory = MemoryTracker(enabled=track_memory)
+
 scope.write('acquire:state 0')
 scope.write('acquire:stopafter SEQUENCE')
 scope.write('acquire:state 1')
@@ -76,23 +109,48 @@ print("Starting acquisition...")
 t5 = time.perf_counter()
 try:
     r = scope.query('*opc?')
-except pyvisa.errors.VisaIOError as e:
+except (pyvisa.errors.VisaIOError, InstrumentServerError) as e:
     print(f"Timeout error during acquisition: {e}")
 t6 = time.perf_counter()
 print('acquire time: {} s'.format(t6 - t5))
 
-# Transfer waveform data from the oscilloscope
-t7 = time.perf_counter()
-bin_wave = scope.query_binary_values('curve?', datatype='b', container=np.array)
-t8 = time.perf_counter()
-print('transfer time: {} s'.format(t8 - t7))
-
 # Retrieve scaling factors
 tscale = float(scope.query('wfmoutpre:xincr?'))
 tstart = float(scope.query('wfmoutpre:xzero?'))
 vscale = float(scope.query('wfmoutpre:ymult?'))
 voff = float(scope.query('wfmoutpre:yzero?'))
 vpos = float(scope.query('wfmoutpre:yoff?'))
+scaling = dict(zip(scaling_keys, (tscale, tstart, vscale, voff, vpos)))
+
+# Crop data to 10 seconds (triggered captures are used whole to stay coherent)
+record_length_cropped = record_length if triggered else int(sampling_rate * 10)  # 10 seconds
+
+# Transfer waveform data from the oscilloscope
+t7 = time.perf_counter()
+streamed_psd = None
+with memory.stage('transfer'):
+    if transfer_chunk_size is None:
+        bin_wave = scope.query_binary_values('curve?', datatype='b', container=np.array)
+    else:
+        transfer = ChunkedTransfer(scope, record_length, transfer_file, transfer_chunk_size).start()
+        if spectrum_mode == 'psd':
+            streamed_psd = WelchPSD(1 / tscale, nperseg=psd_segment_length, average='median')
+        # Completed chunks are analysed while the following ones are still transferred
+        for start, codes in transfer.chunks():
+            print(f'received samples {start + 1} to {start + len(codes)}')
+            if streamed_psd is not None and start < record_length_cropped:
+                streamed_psd.update(scale_codes(codes[:record_length_cropped - start], scaling,
+                                                work_dtype(low_memory)))
+        bin_wave = transfer.wait()
+        transfer.close()
+t8 = time.perf_counter()
+print('transfer time: {} s'.format(t8 - t7))
+
+# Archive the raw codes together with their scaling
+with WaveformArchive('raw_captures.h5') as archive:
+    archive.write_capture(f'scope_{time.strftime("%Y%m%d_%H%M%S")}', {channel: bin_wave},
+                          {channel: scaling},
+                          sampling_rate=sampling_rate, scope_idn=scope_idn)
 
 r = int(scope.query('*esr?'))
 print('event status register: 0b{:08b}'.format(r))
@@ -100,27 +158,38 @@ r = scope.query('allev?').strip()
 print('all event messages: {}'.format(r))
 
 scope.close()
-rm.close()
 
 # Create scaled vectors for the time-domain plot
-total_time = tscale * record_length
-tstop = tstart + total_time
-scaled_time = np.linspace(tstart, tstop, num=record_length, endpoint=False)
-unscaled_wave = np.array(bin_wave, dtype='double')
-scaled_wave = (unscaled_wave - vpos) * vscale + voff
+with memory.stage('scaling'):
+    if low_memory:
+        # Scale only the cropped part, without a double precision copy of the codes
+        scaled_time_cropped = time_vector(scaling, 0, record_length_cropped, work_dtype(low_memory))
+        scaled_wave_cropped = scale_codes(bin_wave[:record_length_cropped], scaling, work_dtype(low_memory))
+        del bin_wave
+    else:
+        total_time = tscale * record_length
+        tstop = tstart + total_time
+        scaled_time = np.linspace(tstart, tstop, num=record_length, endpoint=False)
+        unscaled_wave = np.array(bin_wave, dtype='double')
+        scaled_wave = (unscaled_wave - vpos) * vscale + voff
+
+        scaled_time_cropped = scaled_time[:record_length_cropped]
+        scaled_wave_cropped = scaled_wave[:record_length_cropped]
 
 # Adjust the vertical range to show the entire signal
 vertical_range = 2  # Adjust this value based on the expected signal range
 
-# Crop data to 10 seconds
-record_length_cropped = int(sampling_rate * 10)  # 10 seconds
-scaled_time_cropped = scaled_time[:record_length_cropped]
-scaled_wave_cropped = scaled_wave[:record_length_cropped]
-
 # Perform FFT and prepare frequency-domain data for the cropped data
-fft_result = np.fft.fft(scaled_wave_cropped)
-fft_freq = np.fft.fftfreq(record_length_cropped, d=tscale)
-fft_magnitude = np.abs(fft_result) / record_length_cropped
+with memory.stage('spectrum'):
+    if streamed_psd is not None:
+        psd_freq, psd_values = streamed_psd.result()
+    elif spectrum_mode == 'psd':
+        psd_freq, psd_values = welch_psd(array_chunks(scaled_wave_cropped, 1 / tscale),
+                                         nperseg=psd_segment_length, average='median')
+    else:
+        fft_freq, fft_magnitude = fftbackend.magnitude_spectrum(scaled_wave_cropped, tscale)
+if track_memory:
+    print(memory.report())
 
 # Plot time-domain signal for cropped data
 plt.figure(figsize=(12, 6))
@@ -134,10 +203,15 @@ plt.show()
 
 # Plot frequency-domain signal for cropped data
 plt.figure(figsize=(12, 6))
-plt.plot(fft_freq[:record_length_cropped // 2], fft_magnitude[:record_length_cropped // 2])
-plt.title('FFT')
+if spectrum_mode == 'psd':
+    plt.loglog(psd_freq[1:], np.sqrt(psd_values[1:]))
+    plt.title('Median averaged spectrum')
+    plt.ylabel('Amplitude spectral density (V/sqrt(Hz))')
+else:
+    plt.plot(fft_freq[:record_length_cropped // 2], fft_magnitude[:record_length_cropped // 2])
+    plt.title('FFT')
+    plt.ylabel('Magnitude')
 plt.xlabel('Frequency (Hz)')
-plt.ylabel('Magnitude')
 plt.grid(True)
 plt.show()
 
@@ -0,0 +1,84 @@
+import queue
+import threading
+import numpy as np
+
+# Sample types of 'curve?' for wfmoutpre:byt_n 1 and 2
+code_types = {'b': np.int8, 'h': np.int16}
+
+
+# Chunked waveform transfer: the record of the current data source is read in windows of
+# chunk_size samples (data:start/data:stop + curve?) straight into a preallocated
+# memory-mapped .npy file, so neither a single VISA read nor host RAM limits the record
+# length and the timeout only has to cover one chunk. The transfer runs in a thread and
+# chunks() yields every window as soon as it has arrived, so analysis overlaps the rest
+# of the transfer. The scope must not be used by anything else until the transfer is done.
+class ChunkedTransfer:
+    def __init__(self, scope, record_length, file_path, chunk_size=1000000, datatype='b'):
+        self.scope = scope
+        self.record_length = record_length
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.datatype = datatype
+        self.codes = np.lib.format.open_memmap(file_path, mode='w+', dtype=code_types[datatype],
+                                               shape=(record_length,))
+        self._done = queue.Queue()
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for start in range(0, self.record_length, self.chunk_size):
+                stop = min(start + self.chunk_size, self.record_length)
+                self.scope.write(f'data:start {start + 1}')
+                self.scope.write(f'data:stop {stop}')
+                codes = self.scope.query_binary_values('curve?', datatype=self.datatype, container=np.array)
+                if len(codes) != stop - start:
+                    raise IOError(f'expected {stop - start} samples from {start + 1}, got {len(codes)}')
+                self.codes[start:stop] = codes
+                self._done.put((start, stop))
+            # Leave the data window on the whole record for the following queries
+            self.scope.write('data:start 1')
+            self.scope.write(f'data:stop {self.record_length}')
+            self.codes.flush()
+            self._done.put(None)
+        except Exception as e:
+            self._done.put(e)
+
+    # Yield (start, codes) of every completed chunk in order, until the record is complete
+    def chunks(self):
+        while not self._finished:
+            item = self._done.get()
+            if item is None:
+                self._finished = True
+                return
+            if isinstance(item, Exception):
+                raise item
+            start, stop = item
+            yield start, self.codes[start:stop]
+
+    # Wait for the whole record and return it (memory-mapped)
+    def wait(self):
+        for _ in self.chunks():
+            pass
+        self._thread.join()
+        return self.codes
+
+    # Flush the file and drop the reference of the transfer to the memory map. The map is
+    # released once the codes returned by wait() are not referenced anymore either; until
+    # then the file cannot be reopened or removed on Windows
+    def close(self):
+        if self.codes is not None:
+            self.codes.flush()
+            self.codes = None
+
+
+# Transfer the record of the current data source in chunks, returns the memory-mapped codes
+def transfer_waveform(scope, record_length, file_path, chunk_size=1000000, datatype='b'):
+    transfer = ChunkedTransfer(scope, record_length, file_path, chunk_size, datatype).start()
+    codes = transfer.wait()
+    transfer.close()
+    return codes
@@ -0,0 +1,291 @@
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from multiprocessing.managers import BaseManager
+from catalog import DEFAULT_PATH, RunCatalog, parse_point, sweep_files
+
+# The manager exchanges pickles, so it only listens on the local machine unless a host is
+# given, and then only with a shared key from --authkey or this environment variable
+AUTHKEY_ENV = 'SEMPROJECT_AUTHKEY'
+DEFAULT_ADDRESS = ('127.0.0.1', 50300)
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+# Queues shared through the manager server run by the coordinator
+_tasks = queue.Queue()
+_results = queue.Queue()
+
+
+def _get_tasks():
+    return _tasks
+
+
+def _get_results():
+    return _results
+
+
+class QueueManager(BaseManager):
+    pass
+
+
+QueueManager.register('get_tasks', callable=_get_tasks)
+QueueManager.register('get_results', callable=_get_results)
+
+
+# Key given as argument or in the environment, None if there is none
+def get_authkey(authkey=None):
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    if authkey is None:
+        return None
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+# Stable ID of one analysis task: the same file with the same content gives the same ID,
+# so re-running a campaign or retrying a task never produces duplicate results
+def task_id(file_path):
+    stat = os.stat(file_path)
+    key = f'{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+# Standard analysis chain of one file, returns a JSON-serialisable dict
+def analyse_file(file_path):
+    point = parse_point(file_path)
+    if point is None:
+        raise ValueError(f'not a data_<amplitude>_<frequency> file: {file_path}')
+    amplitude, frequency = point
+    result = {'amplitude': amplitude, 'frequency': frequency}
+    if file_path.endswith('.flac'):
+        from process_flac import analyse_flac
+        analysis = analyse_flac(file_path, frequency)
+        result['rms_acceleration'] = float(analysis.rms())
+        result['harmonics'] = analysis.harmonic_amplitudes().tolist()
+    elif file_path.endswith('.csv'):
+        import numpy as np
+        from accel import load_stack, displacement_to_acceleration
+        from multiaxis import load_axes, harmonic_amplitudes, coupling_matrix
+        sample_rate, stack = load_stack([file_path])
+        rms, amplitudes = displacement_to_acceleration(stack, sample_rate, [frequency])
+        result['rms_acceleration'] = float(rms[0])
+        result['harmonics'] = amplitudes[0].tolist()
+        dt, axes = load_axes(file_path)
+        fundamental = harmonic_amplitudes(axes, dt, frequency, 1)[:, 0]
+        result['axis_amplitudes'] = np.abs(fundamental).tolist()
+        result['coupling'] = np.abs(coupling_matrix(fundamental)).tolist()
+    else:
+        raise ValueError(f'unsupported file type: {file_path}')
+    return result
+
+
+# Results store shared by all campaigns; keyed by task ID so writes are idempotent
+class ResultStore:
+    def __init__(self, path='results.db'):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        'task_id TEXT PRIMARY KEY, path TEXT, amplitude REAL, frequency REAL, '
+                        'result TEXT, worker TEXT, finished REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_point ON results (amplitude, frequency)')
+        self.db.commit()
+
+    def done(self, task_ids):
+        known = set()
+        task_ids = list(task_ids)
+        for start in range(0, len(task_ids), 500):
+            batch = task_ids[start:start + 500]
+            rows = self.db.execute(f'SELECT task_id FROM results WHERE task_id IN ({",".join("?" * len(batch))})', batch)
+            known.update(row[0] for row in rows)
+        return known
+
+    def put(self, task_id, path, result, worker):
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (task_id, path, result['amplitude'], result['frequency'], json.dumps(result), worker, time.time()))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# Worker: pull tasks until the coordinator sends None or goes away. Taking a task is
+# reported (ok=None) before the analysis, then the outcome is pushed back
+def worker_main(address, authkey=None):
+    authkey = get_authkey(authkey)
+    if authkey is None:
+        raise ValueError(f'no authkey: pass --authkey or set {AUTHKEY_ENV}')
+    manager = QueueManager(address=address, authkey=authkey)
+    manager.connect()
+    tasks = manager.get_tasks()
+    results = manager.get_results()
+    name = f'{socket.gethostname()}:{os.getpid()}'
+    print(f"Worker {name} connected to {address[0]}:{address[1]}")
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            identifier, file_path = task
+            results.put((identifier, file_path, None, None, name))
+            try:
+                results.put((identifier, file_path, True, analyse_file(file_path), name))
+            except Exception as e:
+                results.put((identifier, file_path, False, f'{type(e).__name__}: {e}', name))
+    except (EOFError, ConnectionError):
+        print(f"Worker {name}: coordinator closed the connection")
+
+
+# Coordinator: shard the files into tasks, serve them to workers, store the results and
+# re-queue tasks that failed or whose worker went silent (up to max_retries times).
+# task_timeout counts from the moment a worker has taken the task, not from queuing.
+# If all local workers have exited and no remote worker has shown up, the remaining
+# tasks are given up. Returns the failed tasks with their errors.
+# Without a key a random one is used, which only the local workers know; binding to
+# another host than the local one requires a key
+def coordinate(file_paths, store_path='results.db', address=DEFAULT_ADDRESS, n_local_workers=None,
+               max_retries=2, task_timeout=600, authkey=None):
+    authkey = get_authkey(authkey)
+    if authkey is None:
+        if address[0] not in LOCAL_HOSTS:
+            raise ValueError(f'binding to {address[0]} needs an authkey: pass --authkey or set {AUTHKEY_ENV}')
+        authkey = os.urandom(32)
+
+    store = ResultStore(store_path)
+    identifiers = {task_id(file_path): file_path for file_path in file_paths}
+    done = store.done(identifiers)
+    todo = {identifier: path for identifier, path in identifiers.items() if identifier not in done}
+    print(f"{len(identifiers)} files, {len(done)} already analysed, {len(todo)} to do")
+
+    manager = QueueManager(address=address, authkey=authkey)
+    server = manager.get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Coordinator serving tasks on {server.address[0]}:{server.address[1]}")
+
+    # Local processes stand in for remote nodes and use the same network path
+    processes = []
+    connect_address = ('127.0.0.1', server.address[1])
+    for _ in range(n_local_workers if n_local_workers is not None else os.cpu_count()):
+        process = multiprocessing.Process(target=worker_main, args=(connect_address, authkey), daemon=True)
+        process.start()
+        processes.append(process)
+    local_workers = {f'{socket.gethostname()}:{process.pid}' for process in processes}
+
+    attempts = {identifier: 0 for identifier in todo}
+    pending = set(todo)  # queued or running
+    in_flight = {}  # running: start time reported by the worker
+    workers = set()
+    for identifier, file_path in todo.items():
+        _tasks.put((identifier, file_path))
+
+    failed = {}
+    while pending:
+        try:
+            identifier, file_path, ok, result, worker = _results.get(timeout=5)
+        except queue.Empty:
+            identifier = None
+        if identifier is not None:
+            workers.add(worker)
+        if identifier is not None and identifier in pending:
+            if ok is None:
+                in_flight[identifier] = time.time()
+            elif ok:
+                store.put(identifier, file_path, result, worker)
+                pending.discard(identifier)
+                in_flight.pop(identifier, None)
+                print(f"{worker} finished {os.path.basename(file_path)}")
+            else:
+                attempts[identifier] += 1
+                in_flight.pop(identifier, None)
+                print(f"{worker} failed on {os.path.basename(file_path)}: {result}")
+                if attempts[identifier] > max_retries:
+                    failed[identifier] = result
+                    pending.discard(identifier)
+                else:
+                    _tasks.put((identifier, file_path))
+
+        # Tasks of workers that disappeared are handed out again
+        now = time.time()
+        for identifier, started in list(in_flight.items()):
+            if now - started > task_timeout:
+                print(f"Task {os.path.basename(todo[identifier])} timed out, re-queued")
+                attempts[identifier] += 1
+                del in_flight[identifier]
+                if attempts[identifier] > max_retries:
+                    failed[identifier] = f'timed out after {task_timeout} s'
+                    pending.discard(identifier)
+                else:
+                    _tasks.put((identifier, todo[identifier]))
+
+        # Local workers that all died (e.g. crashed on import) never take the queued tasks;
+        # without remote workers nobody else will, so stop instead of waiting forever
+        if (processes and not in_flight and not workers - local_workers
+                and not any(process.is_alive() for process in processes)):
+            print("No worker left, giving up on the remaining tasks")
+            for identifier in pending:
+                failed[identifier] = 'no worker left'
+            break
+
+    # One sentinel per worker; remote workers that never took a task stop when the
+    # connection closes
+    for _ in range(len(processes) + len(workers - local_workers)):
+        _tasks.put(None)
+    for process in processes:
+        process.join(timeout=10)
+    store.close()
+
+    for identifier, error in failed.items():
+        print(f"Gave up on {todo[identifier]}: {error}")
+    print("\nEnd")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distributed analysis of sweep data files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    coordinator = subparsers.add_parser('coordinator', help='shard files to workers and collect the results')
+    coordinator.add_argument('directories', nargs='*', help='data directories (default: files of a catalog run)')
+    coordinator.add_argument('--run', default=None, help='catalog run (default: the latest)')
+    coordinator.add_argument('--workers', type=int, default=None, help='local worker processes (default: one per core)')
+    coordinator.add_argument('--host', default=DEFAULT_ADDRESS[0],
+                             help='address to listen on (default: local only; others need a key)')
+    coordinator.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+    coordinator.add_argument('--authkey', default=None, help=f'shared key (default: ${AUTHKEY_ENV})')
+    coordinator.add_argument('--store', default='results.db')
+    worker = subparsers.add_parser('worker', help='pull tasks from a coordinator')
+    worker.add_argument('host')
+    worker.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+    worker.add_argument('--authkey', default=None, help=f'shared key (default: ${AUTHKEY_ENV})')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'worker':
+            worker_main((args.host, args.port), args.authkey)
+            return
+        authkey = get_authkey(args.authkey)
+        if authkey is None and args.host not in LOCAL_HOSTS:
+            raise ValueError(f'binding to {args.host} needs an authkey: pass --authkey or set {AUTHKEY_ENV}')
+    except ValueError as e:
+        parser.error(str(e))
+
+    file_paths = []
+    for directory in args.directories:
+        for pattern in ('data_*.csv', 'data_*.flac'):
+            file_paths.extend(sorted(glob.glob(os.path.join(directory, '**', pattern), recursive=True)))
+    # Captures the sweep rejected and retried stay on disk but are not analysed
+    if args.directories and os.path.isfile(DEFAULT_PATH):
+        with RunCatalog(DEFAULT_PATH) as catalog:
+            rejected = {row['path'] for row in catalog.captures('rejected')}
+        file_paths = [file_path for file_path in file_paths if os.path.abspath(file_path) not in rejected]
+    if not args.directories:
+        for kind in ('csv', 'flac'):
+            file_paths.extend(file_path for _, _, file_path in sweep_files(kind, args.run))
+    coordinate(file_paths, args.store, (args.host, args.port), args.workers, authkey=authkey)
+
+
+if __name__ == '__main__':
+    main()